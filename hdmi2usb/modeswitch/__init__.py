@@ -1,3 +1,19 @@
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+import sys
+
+
+def _get_version():
+    # Finding the version can mean running git, so only do it when asked.
+    from ._version import get_versions
+    return get_versions()['version']
+
+
+if sys.version_info[:2] >= (3, 7):
+    def __getattr__(name):
+        if name == '__version__':
+            global __version__
+            __version__ = _get_version()
+            return __version__
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name))
+else:
+    __version__ = _get_version()
@@ -15,12 +15,25 @@ import os.path
 import sys
 import time
 import subprocess
-import re
 
 from collections import namedtuple
 
-from . import lsusb as usbapi
+from . import sysfs as usbapi
+from . import cache
 from . import files
+from . import flash
+from . import hotplug
+from . import lock
+from . import openocd
+from . import snapshot
+
+try:
+    from . import dfu
+    from . import fx2
+except ImportError:
+    # Without pyusb fall back to running fxload and dfu-util.
+    dfu = None
+    fx2 = None
 
 
 def assert_in(needle, haystack):
@@ -47,15 +60,6 @@ def firmware_path(filepath):
     assert False, "{} not found in {}".format(filepath, locations)
 
 
-def poll_until(condition, timeout_sec, dt=0.1):
-    start_time = time.time()
-    satisfied = condition()
-    while not satisfied and (time.time() - start_time) < timeout_sec:
-        satisfied = condition()
-        time.sleep(dt)
-    return satisfied
-
-
 BOARD_TYPES = [
     'opsis',
     'atlys',
@@ -83,6 +87,29 @@ BOARD_FLASH_MAP = {
     # https://github.com/timvideos/HDMI2USB-litex-firmware/blob/master/targets/mimasv2/base.py#L208-L220
     'mimasv2': {'gateware': 0x0, 'bios': 0x00080000, 'firmware': 0x00088000},
 }
+BOARD_FLASH_SIZE = {
+    'atlys': 0x01000000,  # 128Mbit N25Q128
+    'opsis': 0x01000000,  # 128Mbit N25Q128
+    'mimasv2': 0x00200000,  # 16Mbit M25P16
+}
+
+
+def flash_region(board_type, region):
+    """
+    (start, length) of a region of the SPI flash.
+
+    Each region runs until the next one starts, the last until the end of
+    the flash. 'all' is the whole flash.
+    """
+    size = BOARD_FLASH_SIZE[board_type]
+    if region == 'all':
+        return 0, size
+    regions = BOARD_FLASH_MAP[board_type]
+    assert_in(region, list(regions))
+    start = regions[region]
+    end = min([o for o in regions.values() if o > start] + [size])
+    return start, end - start
+
 
 USBJTAG_MAPPING = {
     'hw_nexys': 'atlys',
@@ -94,9 +121,10 @@ OPENOCD_MAPPING = {
     'atlys': "board/digilent_atlys.cfg",
     'opsis': "board/numato_opsis.cfg",
 }
+# Found with firmware_path() when needed.
 OPENOCD_FLASHPROXY = {
-    'opsis': firmware_path('spartan6/opsis/bscan_spi_xc6slx45t.bit'),
-    'atlys': firmware_path('spartan6/atlys/bscan_spi_xc6slx45.bit'),
+    'opsis': 'spartan6/opsis/bscan_spi_xc6slx45t.bit',
+    'atlys': 'spartan6/atlys/bscan_spi_xc6slx45.bit',
 }
 
 FX2_MODE_MAPPING = {
@@ -105,6 +133,9 @@ FX2_MODE_MAPPING = {
     'eeprom': 'eeprom.ihx',
 }
 
+# How long to wait for the FX2 to come back after loading firmware.
+FX2_REENUMERATE_TIMEOUT = 10
+
 
 BoardBase = namedtuple("Board", ["dev", "type", "state"])
 
@@ -119,21 +150,49 @@ def detach_board_drivers(board, verbose=False):
     if board.dev.inuse():
         if verbose:
             sys.stderr.write("Detaching drivers from board.\n")
+        invalidate_boards()
         board.dev.detach()
 
 
-def load_fx2(board, mode=None, filename=None, verbose=False):
-    if mode is not None:
-        assert filename is None
-        filename = firmware_path(
-            'fx2/{}/{}'.format(board.type, FX2_MODE_MAPPING[mode]))
+def fx2_fingerprint(dev):
+    """What the firmware running on the FX2 reports in its descriptors."""
+    return [dev.vid, dev.pid, dev.did, dev.serialno]
 
-    detach_board_drivers(board, verbose=verbose)
 
-    filepath = firmware_path(filename)
-    assert os.path.exists(filepath), filepath
+def _fx2_records_path():
+    return cache.runtime_path('fx2-loaded.json')
+
+
+def fx2_firmware_running(board, digest):
+    """
+    Check if the firmware with the given digest is what we last loaded onto
+    the FX2 at this port, and the FX2 hasn't re-enumerated since.
+    """
+    record = cache.load_json(_fx2_records_path(), {}).get(board.dev.port)
+    return record == {
+        'firmware': digest,
+        'fingerprint': fx2_fingerprint(board.dev),
+        'path': str(board.dev.path),
+    }
+
+
+def _record_fx2_load(dev, digest):
+    with cache.updating_json(_fx2_records_path(), {}) as records:
+        records[dev.port] = {
+            'firmware': digest,
+            'fingerprint': fx2_fingerprint(dev),
+            'path': str(dev.path),
+        }
 
-    sys.stderr.write("Using FX2 firmware %s\n" % filename)
+
+def _load_fx2_file(board, filepath, verbose=False, verify=False):
+    if fx2 is not None:
+        if verbose:
+            sys.stderr.write("Loading %s onto FX2 at %s\n" % (
+                filepath, board.dev.path))
+        fx2.load_file(
+            fx2.find_device(board.dev.path), filepath, verify=verify)
+        return
 
     cmdline = "fxload -t fx2lp".split()
     cmdline += ["-D", str(board.dev.path)]
@@ -158,40 +217,80 @@ def load_fx2(board, mode=None, filename=None, verbose=False):
             raise
 
 
-def load_fx2_dfu_bootloader(board, verbose=False, filename='boot-dfu.ihex'):
+@lock.locked
+def load_fx2(board, mode=None, filename=None, verbose=False, verify=False,
+             force=False, timeout=FX2_REENUMERATE_TIMEOUT):
     """
-    Loads bootloader firmware onto given board and updates the board to point
-    to correct device. The device is identified using previous SysFs path of
-    the device, which should be guaranteed not to change.
+    Loads firmware onto the FX2 and waits for the board to re-enumerate.
+
+    Returns the board found at the same USB port afterwards. If the firmware
+    is already running on the board (and force isn't set), nothing is loaded
+    and the board is returned as is.
     """
-    # use current sysfs path to later identify the bootloader after enumeration
-    dev_syspath = sorted(board.dev.syspaths)[0]
-    # because the sysfs path does not dissappear after loading new firmware,
-    # we also have to make sure that the device path (/dev/bus/usb/xxx/xxx)
-    # is different to ensure that we are dealing with a new device
-    previous_dev_path = board.dev.path
+    if mode is not None:
+        assert filename is None
+        filename = firmware_path(
+            'fx2/{}/{}'.format(board.type, FX2_MODE_MAPPING[mode]))
+
+    filepath = firmware_path(filename)
+    assert os.path.exists(filepath), filepath
+
+    digest = files.file_digest(filepath)
+    if not force and fx2_firmware_running(board, digest):
+        if verbose:
+            sys.stderr.write(
+                "FX2 firmware %s already running, not reloading.\n" % (
+                    filename))
+        return board
 
-    def is_bootloader(dev):
-        is_new_dev = dev.path != previous_dev_path
-        same_syspath = dev_syspath in dev.syspaths
-        return is_new_dev and same_syspath
+    detach_board_drivers(board, verbose=verbose)
+
+    sys.stderr.write("Using FX2 firmware %s\n" % filename)
+
+    # The sysfs port path (like 3-1.4) stays the same when the FX2
+    # re-enumerates, but the device path (/dev/bus/usb/xxx/xxx) changes.
+    port = board.dev.port
 
-    def find_bootloader():
-        devices = filter(is_bootloader, usbapi.find_usb_devices())
-        return list(devices)
+    def reenumerated(registry):
+        dev = registry.devices.get(port)
+        if dev is None or dev.path == board.dev.path:
+            return None
+        return dev
 
-    load_fx2(board, filename=filename, verbose=verbose)
+    invalidate_boards()
+    with hotplug.HotplugRegistry(
+            classify=classify_device, ports=[port]) as registry:
+        _load_fx2_file(board, filepath, verbose=verbose, verify=verify)
 
-    # wait for the new device to enumerate
-    devices_found = poll_until(condition=find_bootloader, timeout_sec=3)
+        dev = registry.wait_for(reenumerated, timeout=timeout)
+        if not dev:
+            raise SystemError(
+                "Timeout waiting for board at {} to re-enumerate".format(
+                    port))
 
-    assert len(devices_found) > 0, 'Bootloader not found'
-    assert len(devices_found) == 1, 'More than one bootloader found'
+    _record_fx2_load(dev, digest)
+    _follow_dna(board.dev, dev)
 
-    board = Board(dev=devices_found[0], type=board.type, state='dfu-boot')
-    return board
+    new_board = registry.boards.get(port)
+    if new_board is None:
+        new_board = Board(dev=dev, type=board.type, state=None)
+    return new_board
+
+
+@lock.locked
+def load_fx2_dfu_bootloader(board, verbose=False, filename='boot-dfu.ihex',
+                            force=False):
+    """
+    Loads bootloader firmware onto given board and updates the board to point
+    to correct device. The device is identified using the SysFs port path of
+    the device, which should be guaranteed not to change.
+    """
+    new_board = load_fx2(
+        board, filename=filename, verbose=verbose, force=force, timeout=3)
+    return Board(dev=new_board.dev, type=board.type, state='dfu-boot')
 
 
+@lock.locked
 def flash_fx2(board, filename, verbose=False):
     assert filename.endswith('.dfu'), 'Firmware file must be in DFU format.'
 
@@ -202,7 +301,20 @@ def flash_fx2(board, filename, verbose=False):
 
     sys.stderr.write("Using FX2 firmware %s\n" % filename)
 
-    cmdline = ["dfu-util", "-D", filepath]
+    invalidate_boards()
+    if dfu is not None:
+        def progress(sent, total):
+            if verbose:
+                sys.stderr.write("\rDownloaded %i/%i bytes" % (sent, total))
+                if sent == total:
+                    sys.stderr.write("\n")
+
+        dfu.download_file(
+            fx2.find_device(board.dev.path), filepath, progress=progress)
+        return
+
+    # Only talk to the device at this board's USB port.
+    cmdline = ["dfu-util", "-p", board.dev.port, "-D", filepath]
     if verbose:
         cmdline += ["-v", ]
 
@@ -212,7 +324,7 @@ def flash_fx2(board, filename, verbose=False):
     env = os.environ.copy()
     env['PATH'] = env['PATH'] + ':/usr/sbin:/sbin'
 
-    output = subprocess.run(cmdline, stderr=subprocess.STDOUT, env=env)
+    subprocess.run(cmdline, stderr=subprocess.STDOUT, env=env, check=True)
 
 
 class OpenOCDError(subprocess.CalledProcessError):
@@ -220,13 +332,17 @@ class OpenOCDError(subprocess.CalledProcessError):
             self, msg, fatal_errors, retry_errors, returncode, cmd, output):
         subprocess.CalledProcessError.__init__(
             self, returncode, cmd, output)
+        self.fatal_errors = fatal_errors
+        self.retry_errors = retry_errors
+        # Events parsed from the output before the failure.
+        self.events = []
 
         fatal = ""
         if fatal_errors:
             fatal = "\n".join(
                 ["\nFound fatal errors: "] + [" - " + f for f in fatal_errors]
             )
-            retry += "\n"
+            fatal += "\n"
 
         retry = ""
         if retry_errors:
@@ -257,7 +373,31 @@ class OpenOCDRetryError(OpenOCDError):
     pass
 
 
-def _openocd_script(board, script, verbose=False):
+class FlashVerifyError(Exception):
+    def __init__(self, filename, location, offset):
+        self.filename = filename
+        self.location = location
+        self.offset = offset
+        Exception.__init__(
+            self, "Verifying {} written at 0x{:x} failed, first mismatch at "
+            "offset 0x{:x} (flash address 0x{:x})".format(
+                filename, location, offset, location + offset))
+
+
+def _openocd_adapter_args(board, speed=None):
+    """
+    OpenOCD arguments which make it use the JTAG adapter on this board (and
+    not the first one it finds), at the tuned speed.
+    """
+    args = ["-c", "adapter usb location {}".format(board.dev.port)]
+    if speed is None:
+        speed = jtag_speed(board)
+    if speed is not None:
+        args += ["-c", "adapter speed {}".format(speed)]
+    return args
+
+
+def _openocd_script(board, script, verbose=False, speed=None):
     assert board.state == "jtag", board
     assert not board.dev.inuse()
     assert board.type in OPENOCD_MAPPING
@@ -267,6 +407,11 @@ def _openocd_script(board, script, verbose=False):
 
     cmdline = ["openocd"]
     cmdline += ["-f", OPENOCD_MAPPING[board.type]]
+    cmdline += _openocd_adapter_args(board, speed)
+    # Nothing connects to this OpenOCD, so it shouldn't take any ports which
+    # another one might want.
+    cmdline += ["-c", "gdb_port disabled; tcl_port disabled; "
+                "telnet_port disabled"]
     cmdline += ["-c", "; ".join(script)]
     if verbose > 1:
         cmdline += ["--debug={}".format(verbose - 2)]
@@ -278,104 +423,677 @@ def _openocd_script(board, script, verbose=False):
         cmdline,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT)
-    if not verbose:
-        output, _ = p.communicate()
-        output = output.decode('utf-8')
-    else:
-        output = []
-        while True:
-            output.append(p.stdout.readline().decode('utf-8'))
-            sys.stdout.write(output[-1])
-            if p.poll() is not None:
-                break
-        output = "".join(output)
 
-    # Look for common errors in the OpenOCD output
-    retry_strings = [
-        # DNA Failed to read correctly if this error is seen.
-        "DNA = [01]+ \\(0x18181818.*\\)",
-
-        # JTAG Errors
-        "Info : TAP xc6s.tap does not have IDCODE",
-        "Warn : Bypassing JTAG setup events due to errors",
-        "Error: Trying to use configured scan chain anyway...",
-    ]
-    retry_error_msgs = set()
-    for msg in retry_strings:
-        found = re.search(msg, output)
-        if not found:
-            continue
-        retry_error_msgs.add(found.group(0))
-
-    # Look for common errors in the OpenOCD output
-    fatal_strings = [
-        # FIXME: Put something here.
-    ]
-    fatal_error_msgs = set()
-    for msg in fatal_strings:
-        found = re.search(msg, output)
-        if not found:
-            continue
-        fatal_error_msgs.add(found.group(0))
+    # Parse the output as it arrives, so OpenOCD can be stopped as soon as
+    # something goes wrong rather than waiting for it to finish.
+    parser = openocd.OutputParser()
+    killed = False
+    with p.stdout:
+        for line in p.stdout:
+            line = line.decode('utf-8', 'replace')
+            if verbose:
+                sys.stdout.write(line)
+            event = parser.feed(line)
+            if event is not None and event.kind in ('retry', 'fatal'):
+                p.kill()
+                killed = True
+                break
+    p.wait()
 
-    if p.returncode == 0 and not retry_error_msgs.union(fatal_error_msgs):
-        return
+    if p.returncode == 0 and not killed:
+        return parser.events
 
-    if fatal_error_msgs:
+    if parser.fatal:
         msg = "Fatal error!"
         openocd_error = OpenOCDError
     else:
         msg = "Error which means we should retry..."
         openocd_error = OpenOCDRetryError
 
-    raise openocd_error(
+    error = openocd_error(
         msg,
-        fatal_error_msgs,
-        retry_error_msgs,
+        set(parser.fatal),
+        set(parser.retry),
         p.returncode,
         cmdline,
-        output,
+        parser.output(),
     )
+    error.events = parser.events
+    raise error
+
+
+def openocd_session(board, verbose=False):
+    """
+    Start an OpenOCD for the board which stays running between operations.
+
+    Use as a context manager and pass as session to the reset/load/flash
+    functions;
+
+        with openocd_session(board) as session:
+            flash_gateware(board, "gateware.bin", session=session)
+            flash_bios(board, "bios.bin", session=session)
+    """
+    assert board.state == "jtag", board
+    assert not board.dev.inuse()
+    assert board.type in OPENOCD_MAPPING
+    return openocd.OpenOCDSession(
+        OPENOCD_MAPPING[board.type], _openocd_adapter_args(board),
+        verbose=verbose)
+
+
+# Commands after which the SPI flash proxy is no longer loaded in the FPGA.
+PROXY_REPLACED_BY = ("pld load", "reset")
+
+# Prints the Device DNA, which uniquely identifies the FPGA.
+DNA_COMMAND = "xc6s_print_dna xc6s.tap"
+
+# Seconds a Device DNA read from a board is trusted for.
+DNA_MAX_AGE = 60 * 60
+
+# What OpenOCD should run for one operation. done() (if given) is called
+# once the commands have succeeded, failed() (if given) when they might have
+# been started but didn't finish.
+Step = namedtuple("Step", ["setup", "commands", "done", "failed"])
+Step.__new__.__defaults__ = (None, None)
+
+
+def _openocd_merge(steps, markers=False):
+    """
+    Merge steps into a single OpenOCD script.
+
+    Setup commands only run the first time a step needs them, unless
+    something in between has replaced the SPI flash proxy. With markers,
+    the script echoes openocd.STEP_MARKER after each step.
+    """
+    done = set()
+    script = []
+    for i, step in enumerate(steps):
+        for cmd in step.setup:
+            if cmd not in done:
+                script.append(cmd)
+                done.add(cmd)
+        for cmd in step.commands:
+            script.append(cmd)
+            if cmd.startswith(PROXY_REPLACED_BY):
+                done = set(
+                    c for c in done if not c.startswith("jtagspi_init"))
+        if markers:
+            script.append('echo "{} {}"'.format(openocd.STEP_MARKER, i))
+    return script
+
+
+class RetryPolicy(object):
+    """
+    How to retry a JTAG step which failed with an OpenOCDRetryError.
+
+     * attempts - Number of times to try each step
+     * backoff  - Seconds to wait before the first retry, doubling after that
+     * reswitch - Reload the FX2 firmware between attempts, which resets the
+                  JTAG adapter
+    """
+
+    def __init__(self, attempts=1, backoff=1.0, reswitch=False):
+        assert attempts >= 1, attempts
+        self.attempts = attempts
+        self.backoff = backoff
+        self.reswitch = reswitch
+
+    def delay(self, attempt):
+        """Seconds to wait after the given (1 based) attempt failed."""
+        return self.backoff * 2 ** (attempt - 1)
+
+
+def board_id(board):
+    """Identifies a board between runs, by its serial number and USB port."""
+    return "{} {} {}".format(board.type, board.dev.serialno, board.dev.port)
+
+
+def _retry_stats_path():
+    return cache.cache_path('retries.json')
+
+
+def record_retry(board, errors, failed):
+    """
+    Record that OpenOCD failed on the board with the given retry errors.
+
+    failed is True when there were no attempts left.
+    """
+    with cache.updating_json(_retry_stats_path(), {}) as stats:
+        entry = stats.setdefault(
+            board_id(board), {'retries': 0, 'failures': 0, 'errors': {}})
+        if failed:
+            entry['failures'] += 1
+        else:
+            entry['retries'] += 1
+        for error in errors:
+            entry['errors'][error] = entry['errors'].get(error, 0) + 1
+
+
+def _dna_path():
+    return cache.runtime_path('dna.json')
+
+
+def cached_dna(board, max_age=DNA_MAX_AGE):
+    """
+    Device DNA last read from the board at this USB port, or None if it
+    isn't known (or was read more than max_age seconds ago).
+
+    The DNA is kept while the FX2 firmware is changed by load_fx2(), but is
+    forgotten as soon as any other device shows up at the port.
+    """
+    entry = cache.load_json(_dna_path(), {}).get(board.dev.port)
+    if entry is None or entry.get('path') != str(board.dev.path):
+        return None
+    if max_age is not None and time.time() - entry['time'] > max_age:
+        return None
+    return entry['dna']
+
+
+def record_dna(board, events):
+    """Remember the Device DNA from the parsed OpenOCD output (if any)."""
+    for event in events:
+        if event.kind == 'dna':
+            with cache.updating_json(_dna_path(), {}) as known:
+                known[board.dev.port] = {
+                    'dna': event.value,
+                    'time': time.time(),
+                    'path': str(board.dev.path),
+                }
+            return event.value
+    return None
+
+
+def _follow_dna(old_dev, new_dev):
+    """Keep the DNA of a board whose FX2 we made re-enumerate."""
+    with cache.updating_json(_dna_path(), {}) as known:
+        entry = known.get(old_dev.port)
+        if entry is not None and entry.get('path') == str(old_dev.path):
+            entry['path'] = str(new_dev.path)
+
+
+def _parse_output(output):
+    parser = openocd.OutputParser()
+    for line in (output or "").splitlines(True):
+        parser.feed(line)
+    return parser
+
+
+@lock.locked
+def read_dna(board, verbose=False):
+    """Device DNA of the board, only using JTAG if it isn't cached."""
+    dna = cached_dna(board)
+    if dna is None:
+        events = _openocd_script(
+            board, ["init", DNA_COMMAND, "exit"], verbose=verbose)
+        dna = record_dna(board, events)
+    return dna
+
+
+def _skip_known_dna(board, steps):
+    """Drop reading the DNA from the steps when it is already known."""
+    if cached_dna(board) is None:
+        return steps
+    return [
+        step._replace(setup=[c for c in step.setup if c != DNA_COMMAND])
+        for step in steps]
+
+
+# Adapter speeds (in kHz) tried by tune_jtag, slowest first.
+JTAG_SPEEDS = [
+    1000, 2000, 3000, 4000, 6000, 8000, 10000, 12000, 16000, 20000, 24000,
+    30000,
+]
+
+# How many times the DNA is read at each speed while tuning.
+JTAG_TUNE_READS = 3
+
+# How much of the flash is read at each speed while tuning.
+JTAG_TUNE_BYTES = 0x10000
+
+# Fraction of the fastest speed which worked that is used afterwards.
+JTAG_SPEED_MARGIN = 0.75
+
+# Boards which have had errors at their tuned speed in this process.
+_jtag_fallback = set()
+
+
+def _jtag_speeds_path():
+    return cache.cache_path('jtag-speeds.json')
+
+
+def jtag_speed(board):
+    """Tuned adapter speed in kHz for the board, None for the default."""
+    if board_id(board) in _jtag_fallback:
+        return None
+    entry = cache.load_json(_jtag_speeds_path(), {}).get(board_id(board))
+    if entry is None:
+        return None
+    return entry['speed']
+
+
+def jtag_fallback(board):
+    """Go back to the default adapter speed after errors at the tuned one."""
+    if jtag_speed(board) is not None:
+        sys.stderr.write(
+            "Going back to the default JTAG speed for {}\n".format(
+                board_id(board)))
+        _jtag_fallback.add(board_id(board))
+
+
+@lock.locked
+def tune_jtag(board, speeds=JTAG_SPEEDS, verbose=False):
+    """
+    Find the fastest adapter speed the board works reliably at.
+
+    Each speed is tried by reading the DNA JTAG_TUNE_READS times and the
+    start of the flash, stopping at the first speed with errors or results
+    which differ from the slowest speed. The fastest speed which worked (less
+    JTAG_SPEED_MARGIN) is stored and used from then on.
+    """
+    reference = None
+    best = None
+    for speed in speeds:
+        readpath = _tmp_path(board, "tune-{}.bin".format(speed))
+        script = ["init"]
+        script += [DNA_COMMAND] * JTAG_TUNE_READS
+        script += [_jtagspi_init(board)]
+        script += read_flash_step(
+            board, 0, JTAG_TUNE_BYTES, readpath, verbose).commands
+        script += ["exit"]
+        try:
+            events = _openocd_script(board, script, verbose, speed=speed)
+        except OpenOCDError:
+            if verbose:
+                sys.stderr.write("{} kHz failed\n".format(speed))
+            break
+
+        dnas = [event.value for event in events if event.kind == 'dna']
+        with open(readpath, 'rb') as f:
+            result = (dnas, f.read())
+        if reference is None:
+            reference = result
+        if len(dnas) != JTAG_TUNE_READS or len(set(dnas)) != 1 or (
+                result != reference):
+            if verbose:
+                sys.stderr.write("{} kHz gave bad reads\n".format(speed))
+            break
+        if verbose:
+            sys.stderr.write("{} kHz worked\n".format(speed))
+        best = speed
+
+    assert best is not None, "JTAG doesn't work at {} kHz".format(speeds[0])
+    speed = int(best * JTAG_SPEED_MARGIN)
+
+    with cache.updating_json(_jtag_speeds_path(), {}) as profiles:
+        profiles[board_id(board)] = {'speed': speed, 'fastest': best}
+    _jtag_fallback.discard(board_id(board))
+    return speed
+
+
+def _openocd_session_step(board, session, step):
+    try:
+        for cmd in step.setup:
+            output = session.once(cmd)
+            if cmd == DNA_COMMAND and output:
+                record_dna(board, _parse_output(output).events)
+        for cmd in step.commands:
+            session.command(cmd)
+            if cmd.startswith(PROXY_REPLACED_BY):
+                session.forget("jtagspi_init")
+    except openocd.OpenOCDSessionError as e:
+        parser = _parse_output(e.output)
+        if not parser.retry:
+            raise
+        # Start the step again from scratch.
+        session.forget("")
+        raise OpenOCDRetryError(
+            "Error which means we should retry...", set(),
+            set(parser.retry), None, e.cmd, e.output)
+
+
+def _step_done(step):
+    if step.done is not None:
+        step.done()
 
 
-def _openocd_flash(board, filepath, location, verbose=False):
+def _step_failed(step):
+    if step.failed is not None:
+        step.failed()
+
+
+@lock.locked
+def openocd_run(board, steps, verbose=False, session=None, retry=None):
+    """
+    Run the steps on the board in order.
+
+    Without a session, a new OpenOCD is started which runs all the steps as
+    one script. With one, setup commands which have already run in the
+    session are skipped.
+
+    When OpenOCD fails in a way which means it should be retried, the steps
+    from the one which failed onwards are run again as the RetryPolicy
+    allows.
+    """
+    if retry is None:
+        retry = RetryPolicy()
+
+    # Steps with nothing to do (like flashing something which hasn't
+    # changed) don't need OpenOCD at all.
+    for step in steps:
+        if not step.commands and step.done is not None:
+            step.done()
+    steps = [step for step in steps if step.commands]
+    if not steps:
+        return
+    steps = _skip_known_dna(board, steps)
+
+    flashing = any(
+        cmd.startswith("jtagspi_program")
+        for step in steps for cmd in step.commands)
+    # New gateware can change how the board shows up on USB.
+    if any(cmd.startswith(PROXY_REPLACED_BY)
+           for step in steps for cmd in step.commands):
+        invalidate_boards()
+    done = 0
+    try:
+        attempt = 1
+        while True:
+            try:
+                if session is None:
+                    events = _openocd_script(
+                        board,
+                        _openocd_merge(steps[done:], markers=True) + ["exit"],
+                        verbose=verbose)
+                    record_dna(board, events)
+                    for step in steps[done:]:
+                        _step_done(step)
+                        done += 1
+                else:
+                    while done < len(steps):
+                        _openocd_session_step(board, session, steps[done])
+                        _step_done(steps[done])
+                        done += 1
+                return
+            except OpenOCDRetryError as e:
+                if session is None:
+                    record_dna(board, e.events)
+                    finished = [ev for ev in e.events if ev.kind == 'step']
+                    for step in steps[done:done + len(finished)]:
+                        _step_done(step)
+                    if finished:
+                        done += len(finished)
+                        attempt = 1
+
+                errors = e.retry_errors
+                if not errors:
+                    errors = ["exit code {}".format(e.returncode)]
+                failed = attempt >= retry.attempts
+                record_retry(board, errors, failed)
+                if failed:
+                    raise
+                if session is None:
+                    jtag_fallback(board)
+
+                delay = retry.delay(attempt)
+                sys.stderr.write(
+                    "OpenOCD failed ({}), retrying step {} of {} in "
+                    "{:.1f}s\n".format(
+                        ", ".join(sorted(errors)), done + 1, len(steps),
+                        delay))
+                time.sleep(delay)
+                attempt += 1
+
+                if retry.reswitch and session is None:
+                    board = load_fx2(
+                        board, mode=board.state, verbose=verbose, force=True)
+    except BaseException as e:
+        # Whatever OpenOCD read before failing (like the DNA) is still true.
+        if isinstance(e, OpenOCDError):
+            record_dna(board, e.events)
+        for step in steps[done:]:
+            _step_failed(step)
+        raise
+    finally:
+        if flashing:
+            print("After flashing, the board will need to be power cycled.")
+
+
+def _jtagspi_init(board):
     assert board.type in OPENOCD_FLASHPROXY
-    proxypath = os.path.abspath(OPENOCD_FLASHPROXY[board.type])
+    proxypath = firmware_path(OPENOCD_FLASHPROXY[board.type])
     assert os.path.exists(proxypath), proxypath
+    return "jtagspi_init 0 {}".format(proxypath)
+
+
+def _flash_setup(board):
+    setup = ["init"]
+    setup += [DNA_COMMAND]
+    setup += [_jtagspi_init(board)]
+    return setup
+
+
+def read_flash_step(board, location, length, filename, verbose=False):
+    script = ["flash read_bank 0 {} 0x{:x} 0x{:x}".format(
+        filename, location, length)]
+    return Step(_flash_setup(board), script)
 
-    script = ["init"]
-    script += ["xc6s_print_dna xc6s.tap"]
-    script += ["jtagspi_init 0 {}".format(proxypath)]
 
+def read_region_step(board, region, filename, verbose=False):
+    """Step to read a region of the SPI flash (see flash_region) to a file."""
+    location, length = flash_region(board.type, region)
+    return read_flash_step(board, location, length, filename, verbose)
+
+
+def _tmp_path(board, name):
+    """Temporary file only used for this board."""
+    return flash.tmp_path(name, owner=board.dev.port)
+
+
+def read_flash(board, location, length, filename=None, verbose=False,
+               session=None, retry=None):
+    """Read length bytes of the SPI flash at location into a file."""
+    if filename is None:
+        filename = _tmp_path(board, "read-{:08x}.bin".format(location))
+    openocd_run(
+        board, [read_flash_step(board, location, length, filename, verbose)],
+        verbose=verbose, session=session, retry=retry)
+    return filename
+
+
+def dna_key(board):
+    """
+    Identifies the board itself between runs by its type and Device DNA, as
+    nothing else tells boards apart (ixo-usb-jtag gives them all the same
+    serial number). None if the DNA isn't known.
+    """
+    dna = cached_dna(board)
+    if dna is None:
+        return None
+    return "{} {}".format(board.type, dna)
+
+
+def written_record(board):
+    """
+    WrittenRecord for the board (see dna_key), None if the DNA isn't known.
+    The DNA is never read just for this.
+    """
+    key = dna_key(board)
+    if key is None:
+        return None
+    return flash.WrittenRecord(key)
+
+
+def _verify_parts(parts, readback):
+    for (path, offset), readpath in zip(parts, readback):
+        mismatch = flash.compare_files(path, readpath)
+        if mismatch is not None:
+            raise FlashVerifyError(path, offset, mismatch)
+
+
+def snapshot_step(board, store=None, verbose=False):
+    """
+    Step to read all of the SPI flash into a snapshot in the store.
+
+    What was read is also recorded as written, so later diffs against the
+    board don't need to read it back.
+    """
+    if store is None:
+        store = snapshot.SnapshotStore()
+
+    regions = sorted(
+        BOARD_FLASH_MAP[board.type].items(), key=lambda item: item[1])
+    parts = []
+    script = []
+    for name, _ in regions:
+        location, length = flash_region(board.type, name)
+        filename = _tmp_path(board, "snapshot-{}.bin".format(name))
+        script += read_flash_step(
+            board, location, length, filename, verbose).commands
+        parts.append((name, location, filename))
+
+    def done():
+        # The DNA was read along with the flash.
+        key = dna_key(board)
+        assert key is not None, "Device DNA of {} not read".format(board)
+        path = store.add(key, board.type, parts)
+        # Recorded as one image, so the sectors shared between regions are
+        # recorded whole.
+        image = flash.FlashImage(
+            [(location, filename) for _, location, filename in parts])
+        written_record(board).record(flash.read_mapped(image.write(
+            _tmp_path(board, "snapshot.bin"))), image.start, erased=False)
+        print("Snapshot saved to {}".format(path))
+    return Step(_flash_setup(board), script, done)
+
+
+def restore_steps(board, name='latest', store=None, verbose=False,
+                  diff='cache', verify=False):
+    """
+    Steps to put a snapshot back onto the board's SPI flash.
+
+    The regions are written as one image, so sectors shared by two regions
+    are programmed with both of them. Only the chunks which differ from
+    what is on the board are written.
+    """
+    if store is None:
+        store = snapshot.SnapshotStore()
+
+    if not os.path.exists(name) and cached_dna(board) is None:
+        # Snapshots are found by the DNA of the board.
+        read_dna(board, verbose=verbose)
+    path = store.find(dna_key(board), name)
+    manifest = store.load(path)
+    assert manifest['type'] == board.type, (
+        "{} is a snapshot of a {} board".format(path, manifest['type']))
+    if verbose:
+        sys.stderr.write("Restoring {}\n".format(path))
+
+    parts = []
+    for region in manifest['regions']:
+        parts.append((region['start'], store.write_region(
+            region,
+            _tmp_path(board, "restore-{}.bin".format(region['name'])))))
+    image = flash.FlashImage(parts)
+    assert len(image) == sum(r['length'] for r in manifest['regions']), (
+        "{} has gaps between its regions".format(path))
+    filepath = image.write(_tmp_path(board, "restore.bin"))
+    return [_openocd_flash(
+        board, filepath, image.start, verbose=verbose, diff=diff,
+        verify=verify)]
+
+
+def _openocd_flash(board, filepath, location, verbose=False, diff=None,
+                   verify=False):
+    """
+    Step to program the file into the SPI flash at location.
+
+    With diff, only the sectors which differ from what is in the flash are
+    programmed. diff is either 'cache' (trust the record of what was last
+    written to the board, reading back when there isn't one) or 'readback'
+    (always read the flash back first).
+
+    With verify, what was programmed is read back afterwards and compared.
+    """
+    assert diff in (None, 'cache', 'readback'), diff
+    setup = _flash_setup(board)
+
+    script = []
     if verbose > 1:
         script += ["flash banks"]
         script += ["flash list"]
     if verbose > 2:
         script += ["flash info 0"]
 
-    # script += ["flash read_bank 0 backup.bit 0 0x01000000"]
+    record = written_record(board)
+    data = flash.read_mapped(filepath)
+
+    def remember():
+        # When the DNA wasn't known before, it was read while programming.
+        record = written_record(board)
+        if record is not None:
+            record.record(data, location)
+
+    parts = [(filepath, location)]
+    if diff is not None:
+        current = None
+        if diff == 'cache' and record is not None:
+            current = record.known(location, len(data))
+        if current is None:
+            current = flash.read_mapped(read_flash(
+                board, location, len(data), verbose=verbose))
+            # Reading the flash also read the DNA.
+            record = written_record(board)
+        runs = flash.changed_runs(data, location, current)
+        if runs != [(location, len(data))]:
+            parts = flash.write_runs(
+                data, location, runs, os.path.basename(filepath),
+                owner=board.dev.port)
+        if verbose:
+            sys.stderr.write("{}: {} of {} bytes changed\n".format(
+                filepath, sum(size for _, size in runs), len(data)))
+        if not parts:
+            return Step([], [], remember)
+
+    # Until the programming is known to have worked, nothing is known about
+    # the sectors it erases.
+    def forget(record):
+        if record is not None:
+            for path, offset in parts:
+                record.drop(offset, os.path.getsize(path))
+    forget(record)
 
     script += [
-        "jtagspi_program {} 0x{:x}".format(filepath, location),
-        "exit"
+        "jtagspi_program {} 0x{:x}".format(path, offset)
+        for path, offset in parts
     ]
 
-    try:
-        return _openocd_script(board, script, verbose=verbose)
-    finally:
-        print("After flashing, the board will need to be power cycled.")
+    readback = []
+    if verify:
+        for path, offset in parts:
+            readpath = _tmp_path(board, "verify-{:08x}.bin".format(offset))
+            script += ["flash read_bank 0 {} 0x{:x} 0x{:x}".format(
+                readpath, offset, os.path.getsize(path))]
+            readback.append(readpath)
 
+    def done():
+        _verify_parts(parts, readback)
+        remember()
 
-def reset_gateware(board, verbose=False):
-    script = ["init"]
-    script += ["xc6s_print_dna xc6s.tap"]
-    script += ["reset halt"]
-    script += ["exit"]
+    def failed():
+        # The DNA might only have been read by the run which failed.
+        forget(written_record(board))
+    return Step(setup, script, done, failed)
 
-    return _openocd_script(board, script, verbose=verbose)
 
+def reset_gateware_step(board, verbose=False):
+    setup = ["init"]
+    setup += [DNA_COMMAND]
 
-def load_gateware(board, filename, verbose=False):
+    script = ["reset halt"]
+    return Step(setup, script)
+
+
+def load_gateware_step(board, filename, verbose=False):
     filepath = firmware_path(filename)
     assert os.path.exists(filepath), filepath
     assert filename.endswith(".bit"), "Loading requires a .bit file"
@@ -384,197 +1102,434 @@ def load_gateware(board, filename, verbose=False):
         "Bit file must be for {} (not {})".format(
             BOARD_FPGA[board.type], xfile.part))
 
-    script = ["init"]
-    script += ["xc6s_print_dna xc6s.tap"]
-    script += ["pld load 0 {}".format(filepath)]
-    script += ["reset halt"]
-    script += ["exit"]
+    setup = ["init"]
+    setup += [DNA_COMMAND]
 
-    return _openocd_script(board, script, verbose=verbose)
+    script = ["pld load 0 {}".format(filepath)]
+    script += ["reset halt"]
+    return Step(setup, script)
 
 
-def flash_gateware(board, filename, verbose=False):
+def _gateware_file(filename):
     filepath = firmware_path(filename)
     assert os.path.exists(filepath), filepath
     assert filename.endswith(".bin"), "Flashing requires a Xilinx .bin file"
     xfile = files.XilinxBinFile(filepath)
-
-    _openocd_flash(
-        board,
-        filepath,
-        BOARD_FLASH_MAP[board.type]['gateware'],
-        verbose=verbose)
+    return filepath
 
 
-def flash_bios(board, filename, verbose=False):
+def _bios_file(filename):
     filepath = firmware_path(filename)
     assert os.path.exists(filepath), filepath
     assert filename.endswith(".bin"), "Flashing requires a .bin file"
     # FIXME: Bios files have the CRC at the end, should check that here.
+    return filepath
 
-    _openocd_flash(
+
+def _firmware_file(filename):
+    if filename is None:
+        return firmware_path("zero.bin")
+
+    filepath = firmware_path(filename)
+    assert os.path.exists(filepath), filepath
+    assert filename.endswith(".fbi"), "Flashing requires a .fbi file"
+    fbifile = files.FlashBootImageFile(filepath)
+    return filepath
+
+
+def flash_gateware_step(board, filename, verbose=False, diff=None,
+                        verify=False):
+    return _openocd_flash(
+        board,
+        _gateware_file(filename),
+        BOARD_FLASH_MAP[board.type]['gateware'],
+        verbose=verbose,
+        diff=diff,
+        verify=verify)
+
+
+def flash_bios_step(board, filename, verbose=False, diff=None,
+                    verify=False):
+    return _openocd_flash(
         board,
-        filepath,
+        _bios_file(filename),
         BOARD_FLASH_MAP[board.type]['bios'],
-        verbose=verbose)
+        verbose=verbose,
+        diff=diff,
+        verify=verify)
 
 
-def flash_firmware(board, filename, verbose=False):
+def flash_firmware_step(board, filename, verbose=False, diff=None,
+                        verify=False):
     assert board.state == "jtag", board
     assert not board.dev.inuse()
     assert board.type in OPENOCD_MAPPING
 
-    if filename is not None:
-        filepath = firmware_path(filename)
-        assert os.path.exists(filepath), filepath
-        assert filename.endswith(".fbi"), "Flashing requires a .fbi file"
-        fbifile = files.FlashBootImageFile(filepath)
-    else:
-        filepath = firmware_path("zero.bin")
-
-    _openocd_flash(
+    return _openocd_flash(
         board,
-        filepath,
+        _firmware_file(filename),
         BOARD_FLASH_MAP[board.type]['firmware'],
-        verbose=verbose)
+        verbose=verbose,
+        diff=diff,
+        verify=verify)
+
+
+def compose_image(board_type, gateware=None, bios=None, firmware=None,
+                  start=None, clear_firmware=False):
+    """
+    FlashImage with the given gateware, bios and firmware at their offsets
+    in BOARD_FLASH_MAP, checking each fits in its region and that no region
+    between start and the last part is left out.
+
+    With clear_firmware (and no firmware), the firmware region is cleared.
+    """
+    parts = []
+    if gateware is not None:
+        parts.append(('gateware', _gateware_file(gateware)))
+    if bios is not None:
+        parts.append(('bios', _bios_file(bios)))
+    if firmware is not None or clear_firmware:
+        parts.append(('firmware', _firmware_file(firmware)))
+    assert parts, "Nothing to put in the image"
+
+    for region, filepath in parts:
+        location, length = flash_region(board_type, region)
+        size = os.path.getsize(filepath)
+        assert size <= length, (
+            "{} is 0x{:x} bytes, too big for the {} region "
+            "(0x{:x} bytes)".format(filepath, size, region, length))
+
+    # The image is padded out to cover every region between its start and
+    # end, which would erase any region which wasn't asked for.
+    regions = BOARD_FLASH_MAP[board_type]
+    first = min(regions[region] for region, _ in parts)
+    last = max(regions[region] for region, _ in parts)
+    if start is None:
+        start = first
+    skipped = sorted(
+        (region for region, location in regions.items()
+         if start <= location <= last and region not in dict(parts)),
+        key=regions.get)
+    assert not skipped, (
+        "Image would erase the {} region, which isn't being written".format(
+            ", ".join(skipped)))
+
+    return flash.FlashImage(
+        [(BOARD_FLASH_MAP[board_type][region], filepath)
+         for region, filepath in parts],
+        start=start)
+
+
+def regions_share_sectors(board_type, regions, sector_size=flash.SECTOR_SIZE):
+    """
+    Do any of the regions have an erase sector in common? Programming one of
+    them then erases part of the other.
+    """
+    seen = set()
+    for region in set(regions):
+        location, length = flash_region(board_type, region)
+        sectors = set(range(
+            location // sector_size,
+            (location + length - 1) // sector_size + 1))
+        if seen & sectors:
+            return True
+        seen |= sectors
+    return False
+
+
+def flash_composed_step(board, gateware=None, bios=None, firmware=None,
+                        clear_firmware=False, verbose=False, diff=None,
+                        verify=False):
+    """
+    Step which programs gateware, bios and firmware together as one image,
+    with a single jtagspi_program.
+    """
+    image = compose_image(
+        board.type, gateware, bios, firmware, clear_firmware=clear_firmware)
+    filepath = image.write(_tmp_path(board, "image.bin"))
+    return _openocd_flash(
+        board, filepath, image.start, verbose=verbose, diff=diff,
+        verify=verify)
+
+
+def flash_image_step(board, filename, verbose=False, diff=None,
+                     verify=False):
+    """Step to program an image (see compose_image) at the start of flash."""
+    filepath = firmware_path(filename)
+    assert os.path.exists(filepath), filepath
+    assert filename.endswith(".bin"), "Flashing requires a .bin file"
+    size = os.path.getsize(filepath)
+    assert size <= BOARD_FLASH_SIZE[board.type], (
+        "{} is bigger than the flash".format(filepath))
+
+    return _openocd_flash(
+        board, filepath, 0, verbose=verbose, diff=diff, verify=verify)
+
+
+def reset_gateware(board, verbose=False, session=None, retry=None):
+    return openocd_run(
+        board, [reset_gateware_step(board, verbose)],
+        verbose=verbose, session=session, retry=retry)
+
 
+def load_gateware(board, filename, verbose=False, session=None, retry=None):
+    return openocd_run(
+        board, [load_gateware_step(board, filename, verbose)],
+        verbose=verbose, session=session, retry=retry)
 
-flash_image = flash_gateware
 
+def flash_gateware(board, filename, verbose=False, session=None, retry=None,
+                   diff=None, verify=False):
+    return openocd_run(
+        board, [flash_gateware_step(board, filename, verbose, diff, verify)],
+        verbose=verbose, session=session, retry=retry)
+
+
+def flash_bios(board, filename, verbose=False, session=None, retry=None,
+               diff=None, verify=False):
+    return openocd_run(
+        board, [flash_bios_step(board, filename, verbose, diff, verify)],
+        verbose=verbose, session=session, retry=retry)
+
+
+def flash_firmware(board, filename, verbose=False, session=None, retry=None,
+                   diff=None, verify=False):
+    return openocd_run(
+        board, [flash_firmware_step(board, filename, verbose, diff, verify)],
+        verbose=verbose, session=session, retry=retry)
+
+
+def flash_image(board, filename, verbose=False, session=None, retry=None,
+                diff=None, verify=False):
+    return openocd_run(
+        board, [flash_image_step(board, filename, verbose, diff, verify)],
+        verbose=verbose, session=session, retry=retry)
+
+
+# The (vid, pid) of every device classify_device() knows, with the types of
+# board which can use it.
+BOARD_USB_IDS = {
+    (0x1443, 0x0007): ('atlys',),
+    (0x1d50, 0x60b5): ('atlys',),
+    (0x1d50, 0x60b6): ('atlys',),
+    (0x1d50, 0x60b7): ('atlys',),
+    (0x04b4, 0x8613): ('opsis',),
+    (0x2a19, 0x5440): ('opsis',),
+    (0x2a19, 0x5441): ('opsis',),
+    (0x2a19, 0x5442): ('opsis',),
+    (0x16c0, 0x06ad): ('atlys', 'opsis'),
+}
+
+# Exar USB-UART found next to the Digilent Atlys board.
+EXAR_UART_ID = (0x04e2, 0x1410)
+
+
+def board_usb_ids(types=None):
+    """The (vid, pid) which boards of the given types can have."""
+    ids = set()
+    for usb_id, id_types in BOARD_USB_IDS.items():
+        if types is None or set(types) & set(id_types):
+            ids.add(usb_id)
+    if types is None or 'atlys' in types:
+        ids.add(EXAR_UART_ID)
+    return ids
+
+
+def classify_device(device):
+    """Return the Board the given USB device belongs to, or None."""
+    # https://github.com/timvideos/HDMI2USB/wiki/USB-IDs
+    # Digilent Atlys
+    # --------------------------
+    # Digilent Atlys board with stock "Adept" firmware
+    # Bus 003 Device 019: ID 1443:0007 Digilent Development board JTAG
+    if device.vid == 0x1443 and device.pid == 0x0007:
+        return Board(dev=device, type="atlys", state="unconfigured")
+
+    # Digilent Atlys board unconfigured mode with Openmoko ID
+    # Bus 003 Device 019: ID 1d50:60b5
+    elif device.vid == 0x1d50 and device.pid == 0x60b5:
+        return Board(dev=device, type="atlys", state="unconfigured")
+
+    # Digilent Atlys board JTAG/firmware upgrade mode with Openmoko ID.
+    # Device ID 0x10 indicates test JTAG mode, 0x11 indicates test Serial,
+    # 0x12 indicates test Audio and 0x13 indicates test UVC.
+    # Bus 003 Device 019: ID 1d50:60b6
+    elif device.vid == 0x1d50 and device.pid == 0x60b6:
+        if device.did == '0001':
+            return Board(dev=device, type="atlys", state="jtag")
+        elif device.did == '0010':
+            return Board(dev=device, type="atlys", state="test-jtag")
+        elif device.did == '0011':
+            return Board(dev=device, type="atlys", state="test-serial")
+        elif device.did == '0012':
+            return Board(dev=device, type="atlys", state="test-audio")
+        elif device.did == '0013':
+            return Board(dev=device, type="atlys", state="test-uvc")
+        else:
+            return Board(dev=device, type="atlys", state="test-???")
+
+    # Digilent Atlys board in operational mode with Openmoko ID.
+    # Bus 003 Device 019: ID 1d50:60b7
+    elif device.vid == 0x1d50 and device.pid == 0x60b7:
+        return Board(dev=device, type="atlys", state="operational")
+
+    # Numato Opsis
+    # --------------------------
+    # The Numato Opsis will boot in the following mode when the EEPROM is
+    # not set up correctly.
+    # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#failsafe-mode
+    # Bus 003 Device 091: ID 04b4:8613 Cypress Semiconductor Corp.
+    # CY7C68013 EZ-USB FX2 USB 2.0 Development Kit
+    elif device.vid == 0x04b4 and device.pid == 0x8613:
+        return Board(dev=device, type="opsis", state="unconfigured")
+
+    # The preproduction Numato Opsis shipped to Champions will boot into
+    # this mode by default.
+    # The production Numato Opsis will fallback to booting in the following
+    # mode when the FPGA doesn't have EEPROM emulation working.
+    # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#unconfigured-mode
+    # Bus 003 Device 091: ID 2a19:5440 Numato Opsis (Unconfigured Mode)
+    elif device.vid == 0x2A19 and device.pid == 0x5440:
+        return Board(dev=device, type="opsis", state="unconfigured")
+
+    # The production Numato Opsis will boot in this mode when SW1 is held
+    # during boot, or when held for 5 seconds with correctly configured
+    # FPGA gateware.
+    # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#usb-jtag-and-usb-uart-mode
+    # Bus 003 Device 091: ID 2a19:5441 Numato Opsis (JTAG and USB Mode)
+    elif device.vid == 0x2A19 and device.pid == 0x5441:
+        if device.did == '0001':
+            return Board(dev=device, type="opsis", state="jtag")
+        elif device.did == '0002':
+            return Board(dev=device, type="opsis", state="eeprom")
+        elif device.did == '0003':
+            return Board(dev=device, type="opsis", state="serial")
+        elif device.did == '0011':
+            return Board(dev=device, type="opsis", state="test-serial")
+        elif device.did == '0012':
+            return Board(dev=device, type="opsis", state="test-audio")
+        elif device.did == '0013':
+            return Board(dev=device, type="opsis", state="test-uvc")
+        else:
+            assert False, "Unknown mode: %s" % device.did
+
+    # The production Numato Opsis will boot in this mode by default.
+    # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#hdmi2usb.tv-mode
+    # Bus 003 Device 091: ID 2a19:5441 Numato Opsis (HDMI2USB.tv mode)
+    elif device.vid == 0x2A19 and device.pid == 0x5442:
+        return Board(dev=device, type="opsis", state="operational")
+
+    # ixo-usb-jtag
+    # --------------------------
+    # Boards loaded with the ixo-usb-jtag firmware from mithro's repo
+    # https://github.com/mithro/ixo-usb-jtag
+    # Bus 003 Device 090: ID 16c0:06ad Van Ooijen Technische Informatica
+    elif device.vid == 0x16c0 and device.pid == 0x06ad:
+        if device.did in ('0001', '0004'):
+            if device.serialno not in USBJTAG_MAPPING:
+                logging.warn("Unknown usb-jtag device! %r (%s)",
+                             device.serialno, device)
+                return None
+            return Board(
+                dev=device, type=USBJTAG_MAPPING[device.serialno],
+                state="jtag")
+        elif device.did == 'ff00':
+            return Board(dev=device, type='opsis', state="jtag")
+        else:
+            logging.warn(
+                "Unknown usb-jtag device version! %r (%s)",
+                device.did,
+                device)
+            return None
+
+    return None
+
+
+def _boards_cache_path():
+    return cache.runtime_path('boards.json')
+
+
+def invalidate_boards():
+    """Make the next find_boards(cached=True) look at sysfs again."""
+    try:
+        os.unlink(_boards_cache_path())
+    except FileNotFoundError:
+        pass
+
+
+def _selector(types, ports):
+    return [
+        sorted(types) if types is not None else None,
+        sorted(ports) if ports is not None else None]
+
+
+def _cached_snapshot(state, selector):
+    """
+    The snapshot saved by find_boards(), if the USB bus hasn't changed and
+    it was looking for the same boards (or all of them).
+    """
+    stored = cache.load_json(_boards_cache_path())
+    if stored is None or stored.get('state') != state:
+        return None
+    if stored.get('selector') not in (selector, [None, None]):
+        return None
+    try:
+        return usbapi.SysfsSnapshot.from_json(stored['snapshot'])
+    except (KeyError, TypeError):
+        return None
+
+
+def find_boards(prefer_hardware_serial=True, verbose=False, cached=False,
+                types=None, ports=None):
+    """
+    Find all the boards plugged in.
+
+    types and ports limit the search to boards of those types and at those
+    USB ports (the Atlys' Exar UART is then only found at those ports too).
+    Only devices with a vid and pid a board could have are read any
+    further.
+
+    With cached set, the boards found last time (by any process) are used
+    as long as no USB device has come, gone or changed driver since.
+    """
+    selector = _selector(types, ports)
+    snapshot = None
+    if cached:
+        state = usbapi.bus_state()
+        snapshot = _cached_snapshot(state, selector)
+    fresh = snapshot is None
+    if fresh:
+        snapshot = usbapi.SysfsSnapshot.take(names=usbapi.matching_ports(
+            ids=board_usb_ids(types), ports=ports))
 
-def find_boards(prefer_hardware_serial=True, verbose=False):
     all_boards = []
     exart_uarts = []
-    for device in usbapi.find_usb_devices():
-        if False:
-            pass
-
-        # https://github.com/timvideos/HDMI2USB/wiki/USB-IDs
-        # Digilent Atlys
-        # --------------------------
-        # Digilent Atlys board with stock "Adept" firmware
-        # Bus 003 Device 019: ID 1443:0007 Digilent Development board JTAG
-        if device.vid == 0x1443 and device.pid == 0x0007:
-            all_boards.append(
-                Board(dev=device, type="atlys", state="unconfigured"))
-
-        # Digilent Atlys board unconfigured mode with Openmoko ID
-        # Bus 003 Device 019: ID 1d50:60b5
-        elif device.vid == 0x1d50 and device.pid == 0x60b5:
-            all_boards.append(
-                Board(dev=device, type="atlys", state="unconfigured"))
-
-        # Digilent Atlys board JTAG/firmware upgrade mode with Openmoko ID.
-        # Device ID 0x10 indicates test JTAG mode, 0x11 indicates test Serial,
-        # 0x12 indicates test Audio and 0x13 indicates test UVC.
-        # Bus 003 Device 019: ID 1d50:60b6
-        elif device.vid == 0x1d50 and device.pid == 0x60b6:
-            if device.did == '0001':
-                all_boards.append(
-                    Board(dev=device, type="atlys", state="jtag"))
-            elif device.did == '0010':
-                all_boards.append(
-                    Board(dev=device, type="atlys", state="test-jtag"))
-            elif device.did == '0011':
-                all_boards.append(
-                    Board(dev=device, type="atlys", state="test-serial"))
-            elif device.did == '0012':
-                all_boards.append(
-                    Board(dev=device, type="atlys", state="test-audio"))
-            elif device.did == '0013':
-                all_boards.append(
-                    Board(dev=device, type="atlys", state="test-uvc"))
-            else:
-                all_boards.append(
-                    Board(dev=device, type="atlys", state="test-???"))
-
-        # Digilent Atlys board in operational mode with Openmoko ID.
-        # Bus 003 Device 019: ID 1d50:60b7
-        elif device.vid == 0x1d50 and device.pid == 0x60b7:
-            all_boards.append(
-                Board(dev=device, type="atlys", state="operational"))
+    for device in usbapi.find_usb_devices(snapshot):
+        if ports is not None and device.port not in ports:
+            continue
 
-        elif device.vid == 0x04e2 and device.pid == 0x1410:
+        if (device.vid, device.pid) == EXAR_UART_ID:
             exart_uarts.append(device)
+            continue
 
-        # Numato Opsis
-        # --------------------------
-        # The Numato Opsis will boot in the following mode when the EEPROM is
-        # not set up correctly.
-        # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#failsafe-mode
-        # Bus 003 Device 091: ID 04b4:8613 Cypress Semiconductor Corp.
-        # CY7C68013 EZ-USB FX2 USB 2.0 Development Kit
-        elif device.vid == 0x04b4 and device.pid == 0x8613:
-            all_boards.append(
-                Board(dev=device, type="opsis", state="unconfigured"))
-
-        # The preproduction Numato Opsis shipped to Champions will boot into
-        # this mode by default.
-        # The production Numato Opsis will fallback to booting in the following
-        # mode when the FPGA doesn't have EEPROM emulation working.
-        # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#unconfigured-mode
-        # Bus 003 Device 091: ID 2a19:5440 Numato Opsis (Unconfigured Mode)
-        elif device.vid == 0x2A19 and device.pid == 0x5440:
-            all_boards.append(
-                Board(dev=device, type="opsis", state="unconfigured"))
-
-        # The production Numato Opsis will boot in this mode when SW1 is held
-        # during boot, or when held for 5 seconds with correctly configured
-        # FPGA gateware.
-        # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#usb-jtag-and-usb-uart-mode
-        # Bus 003 Device 091: ID 2a19:5441 Numato Opsis (JTAG and USB Mode)
-        elif device.vid == 0x2A19 and device.pid == 0x5441:
-            if device.did == '0001':
-                all_boards.append(
-                    Board(dev=device, type="opsis", state="jtag"))
-            elif device.did == '0002':
-                all_boards.append(
-                    Board(dev=device, type="opsis", state="eeprom"))
-            elif device.did == '0003':
-                all_boards.append(
-                    Board(dev=device, type="opsis", state="serial"))
-            elif device.did == '0011':
-                all_boards.append(
-                    Board(dev=device, type="opsis", state="test-serial"))
-            elif device.did == '0012':
-                all_boards.append(
-                    Board(dev=device, type="opsis", state="test-audio"))
-            elif device.did == '0013':
-                all_boards.append(
-                    Board(dev=device, type="opsis", state="test-uvc"))
-            else:
-                assert False, "Unknown mode: %s" % device.did
-
-        # The production Numato Opsis will boot in this mode by default.
-        # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#hdmi2usb.tv-mode
-        # Bus 003 Device 091: ID 2a19:5441 Numato Opsis (HDMI2USB.tv mode)
-        elif device.vid == 0x2A19 and device.pid == 0x5442:
-            all_boards.append(
-                Board(dev=device, type="opsis", state="operational"))
-
-        # ixo-usb-jtag
-        # --------------------------
-        # Boards loaded with the ixo-usb-jtag firmware from mithro's repo
-        # https://github.com/mithro/ixo-usb-jtag
-        # Bus 003 Device 090: ID 16c0:06ad Van Ooijen Technische Informatica
-        elif device.vid == 0x16c0 and device.pid == 0x06ad:
-            if device.did in ('0001', '0004'):
-                if device.serialno not in USBJTAG_MAPPING:
-                    logging.warn("Unknown usb-jtag device! %r (%s)",
-                                 device.serialno, device)
-                    continue
-                all_boards.append(Board(
-                    dev=device, type=USBJTAG_MAPPING[device.serialno],
-                    state="jtag"))
-            elif device.did == 'ff00':
-                all_boards.append(
-                    Board(dev=device, type='opsis', state="jtag"))
-            else:
-                logging.warn(
-                    "Unknown usb-jtag device version! %r (%s)",
-                    device.did,
-                    device)
-                continue
+        board = classify_device(device)
+        if board is None:
+            continue
+        if types is not None and board.type not in types:
+            continue
+        all_boards.append(board)
+
+    if cached and fresh:
+        # Only what is needed to find the boards again is kept. The state
+        # was taken before sysfs was read, so anything changing while it
+        # was being read means the cache is never used.
+        names = [b.dev.port for b in all_boards]
+        names += [d.port for d in exart_uarts]
+        cache.save_json(_boards_cache_path(), {
+            'state': state,
+            'selector': selector,
+            'snapshot': snapshot.subset(names).to_json(),
+        })
 
     # FIXME: This is a horrible hack!?@
     # Patch the Atlys board so the exar_uart is associated with it.
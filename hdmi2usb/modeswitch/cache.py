@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Where hdmi2usb-mode-switch keeps things between runs.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+
+
+def cache_dir():
+    """Directory for data which can be regenerated (~/.cache/hdmi2usb)."""
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'hdmi2usb')
+
+
+def cache_path(*parts):
+    """Path under cache_dir(), creating the parent directories."""
+    path = os.path.join(cache_dir(), *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def runtime_dir():
+    """
+    Directory for state which should not survive a reboot, like which
+    firmware was last loaded onto a board.
+    """
+    for base in ('/run', os.environ.get('XDG_RUNTIME_DIR')):
+        if base and os.access(base, os.W_OK):
+            return os.path.join(base, 'hdmi2usb')
+    return os.path.join(
+        tempfile.gettempdir(), 'hdmi2usb-{}'.format(os.getuid()))
+
+
+def runtime_path(*parts):
+    """Path under runtime_dir(), creating the parent directories."""
+    path = os.path.join(runtime_dir(), *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def load_json(path, default=None):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """Atomically replace the JSON file at path."""
+    with tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(f.name, path)
+
+
+@contextlib.contextmanager
+def updating_json(path, default=None):
+    """
+    Load the JSON file at path to be changed, saving it again afterwards
+    (unless an exception is raised). Other processes updating it at the same
+    time wait for a lock on path + '.lock', so no update is lost.
+    """
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = load_json(path, default)
+        yield data
+        save_json(path, data)
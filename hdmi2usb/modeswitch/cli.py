@@ -13,15 +13,19 @@ import logging
 import os
 import os.path
 import sys
+import threading
 import time
 import subprocess
 
 import argparse
+import contextlib
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from . import boards
-from . import __version__
+from . import lock
+from . import planner
 
 
 def args_parser(board, mode):
@@ -69,9 +73,16 @@ While this *should* be static across reboots, but sadly on some machines it isn'
 
     parser.add_argument(
         '--all',
+        action='store_true',
         help="""\
 Do operation on all boards, otherwise will error if multiple boards are found.
 """)
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=8,
+        help='How many boards to work on at the same time with --all.')
 
     parser.add_argument(
         '--get-usbfs',
@@ -107,6 +118,20 @@ Do operation on all boards, otherwise will error if multiple boards are found.
     parser.add_argument(
         '--flash-image',
         help='Flash a combined gateware+bios+firmware onto the SPI flash.')
+    parser.add_argument(
+        '--compose-image',
+        action='store_true',
+        help="""\
+Combine the gateware, bios and firmware being flashed into one image and
+program it in one go. They have to be next to each other in the flash. Parts
+which share an erase sector (like the bios and firmware) are always combined.
+""")
+    parser.add_argument(
+        '--write-image',
+        help="""\
+Write the combined gateware, bios and firmware image to a file (for use with
+--flash-image) rather than flashing anything.
+""")
     # FPGA
     parser.add_argument(
         '--load-gateware',
@@ -150,6 +175,52 @@ Flash the firmware file for the Soft-CPU onto the SPI flash.
         help="""\
 Clear the firmware file for the Soft-CPU on the SPI flash.
 """)
+    parser.add_argument(
+        '--diff-flash',
+        choices=['cache', 'readback'],
+        help="""\
+Only program the parts of the SPI flash which have changed. 'cache' trusts the
+record of what was last written to the board, 'readback' reads the flash first.
+""")
+    parser.add_argument(
+        '--verify',
+        dest='verify',
+        action='store_true',
+        help="""\
+Read back what was written to the SPI flash and check it (the default).
+""")
+    parser.add_argument(
+        '--no-verify',
+        dest='verify',
+        action='store_false',
+        help='Don\'t read back what was written to the SPI flash.')
+    parser.set_defaults(verify=True)
+    parser.add_argument(
+        '--read-flash',
+        metavar='REGION',
+        choices=['all'] + sorted(boards.BOARD_FLASH_MAP['opsis']),
+        help='Read a region of the SPI flash into the --output file.')
+    parser.add_argument(
+        '--output',
+        '-o',
+        help="""\
+File to write to. Any {port} in it is replaced with the USB port of the board,
+which is needed with --all.
+""")
+    parser.add_argument(
+        '--snapshot',
+        action='store_true',
+        help='Save a snapshot of the whole SPI flash.')
+    parser.add_argument(
+        '--restore',
+        nargs='?',
+        const='latest',
+        metavar='SNAPSHOT',
+        help="""\
+Put a snapshot back onto the SPI flash, only writing what has changed. Defaults
+to the latest snapshot of the board.
+""")
+
     # Create aliases for old lm32 name of the softcpu.
     for action in list(parser._actions):
         aliases = set()
@@ -167,11 +238,64 @@ Clear the firmware file for the Soft-CPU on the SPI flash.
         help='How long to wait in seconds before giving up.',
         type=float)
 
+    parser.add_argument(
+        '--tune-jtag',
+        action='store_true',
+        help="""\
+Find the fastest JTAG clock the board works reliably at, and use it from then
+on.
+""")
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=3,
+        help="""\
+How many times to try a JTAG step which fails in a way that is worth retrying.
+""")
+    parser.add_argument(
+        '--retry-backoff',
+        type=float,
+        default=1.0,
+        help="""\
+Seconds to wait before retrying a JTAG step, doubling with each retry.
+""")
+    parser.add_argument(
+        '--retry-reswitch',
+        action='store_true',
+        help="""\
+Reset the JTAG adapter by reloading the FX2 firmware before retrying.
+""")
+
+    parser.add_argument(
+        '--lock-timeout',
+        type=float,
+        help="""\
+How long to wait in seconds for other programs to finish with a board (default
+is to wait forever).
+""")
+
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help="""\
+Load FX2 firmware even when the board is already running it.
+""")
+
     return parser
 
 
 def find_boards(args):
-    all_boards = boards.find_boards(verbose=args.verbose)
+    # Only devices which could be the boards asked for are looked at.
+    types = None
+    if args.by_type:
+        types = [args.by_type]
+    ports = None
+    if args.by_position:
+        ports = [args.by_position]
+
+    # Anything changing a board invalidates the cache.
+    all_boards = boards.find_boards(
+        verbose=args.verbose, cached=True, types=types, ports=ports)
 
     # Filter out the boards we don't care about
     filtered_boards = []
@@ -199,68 +323,358 @@ def find_boards(args):
                 sys.stderr.write(" Ignore as not type %s\n" % (args.by_type,))
             continue
 
+        if args.by_dna:
+            # Only boards in jtag mode can have their DNA read, for the rest
+            # it has to have been seen recently.
+            dna = boards.cached_dna(board)
+            if dna is None and board.state == "jtag":
+                dna = boards.read_dna(board, verbose=args.verbose)
+            if dna is None or int(dna, 16) != int(args.by_dna, 16):
+                if args.verbose > 0:
+                    sys.stderr.write(" Ignore as DNA %s is not %s\n" % (
+                        dna, args.by_dna))
+                continue
+
         filtered_boards.append(board)
 
+        # Each DNA is unique, so there is no need to read any more of them.
+        if args.by_dna and not args.all:
+            break
+
     return filtered_boards
 
 
 def switch_mode(args, board, newmode):
-    if newmode == "jtag":
-        # Works on all boards
-        pass
-
-    elif newmode in ("serial", "eeprom"):
-        assert board.type == "opsis", (
-            "{} mode only valid on the opsis.".format(newmode))
-
-    elif newmode == "operational":
-        raise NotImplemented("Not yet finished...")
-    else:
-        raise NotImplemented("Unknown mode {}".format(newmode))
-
     if board.state != newmode:
+        # Work out which firmware to load (possibly going through other modes
+        # first) to get the board into the new mode.
+        modeplanner = planner.Planner(board.type)
+        plan = modeplanner.plan(board.state, newmode)
+        if args.verbose:
+            sys.stderr.write(
+                "Going from {} to {} via {}\n".format(
+                    board.state, newmode, " -> ".join(
+                        [board.state] + [t.end for t in plan])))
+
+        timeout = args.timeout
+        if timeout is None:
+            timeout = boards.FX2_REENUMERATE_TIMEOUT
+
+        for transition in plan:
+            old_board = board
+            starttime = time.time()
+            try:
+                if transition.end == 'dfu-boot':
+                    board = boards.load_fx2_dfu_bootloader(
+                        old_board, verbose=args.verbose, force=args.force)
+                else:
+                    # load_fx2 only watches the board's own USB port for it
+                    # to come back.
+                    board = boards.load_fx2(
+                        old_board, mode=transition.end, verbose=args.verbose,
+                        force=args.force, timeout=timeout)
+            except SystemError:
+                modeplanner.record(transition, time.time() - starttime, False)
+                raise
+            ok = board.state == transition.end
+            modeplanner.record(transition, time.time() - starttime, ok)
+            assert ok, (board, transition)
+
+            if args.verbose:
+                sys.stderr.write("Board was {!r}\n".format(old_board))
+                sys.stderr.write("Board now {!r}\n".format(board))
+    else:
         if args.verbose:
             sys.stderr.write(
-                "Going from {} to {}\n".format(board.state, newmode))
+                "Board already in required mode ({!s})\n".format(
+                    board.state))
 
-        old_board = board
-        boards.load_fx2(
-            old_board, mode=newmode, verbose=args.verbose)
+    return board
 
-        starttime = time.time()
-        while True:
-            found_boards = find_boards(args)
 
-            found_board = None
-            for new_board in found_boards:
-                if new_board.type == old_board.type:
-                    if new_board.state == old_board.state:
-                        continue
-                    assert new_board.state == newmode
-                    found_board = new_board
-                    break
-            else:
-                time.sleep(1)
+# Operations done over JTAG, in the order they are run when several are given
+# on one command line. The SPI flash is read before anything is written to
+# it, everything is written before any gateware is loaded (which replaces the
+# SPI flash proxy), and a reset comes last.
+JTAG_OPERATIONS = [
+    # Read the SPI flash, before anything is written to it.
+    ('snapshot', boards.snapshot_step),
+    ('read_flash', boards.read_region_step),
+    # Put back a snapshot, before anything else is written on top of it.
+    ('restore', boards.restore_steps),
+    # Flash an image with gateware+bios+firmware into the SPI flash.
+    ('flash_image', boards.flash_image_step),
+    # Flash the gateware into the SPI flash on the board.
+    ('flash_gateware', boards.flash_gateware_step),
+    # Flash the bios into the SPI flash on the board.
+    ('flash_softcpu_bios', boards.flash_bios_step),
+    # Flash the firmware into the SPI flash on the board.
+    ('flash_softcpu_firmware', boards.flash_firmware_step),
+    # Clear the firmware in the SPI flash on the board.
+    ('clear_softcpu_firmware', boards.flash_firmware_step),
+    # Load gateware onto the FPGA
+    ('load_gateware', boards.load_gateware_step),
+    # Reset the gateware running on the board.
+    ('reset_gateware', boards.reset_gateware_step),
+]
+
+
+# Operations which --compose-image combines into one image, with the flash
+# region each writes.
+COMPOSED_OPERATIONS = {
+    'flash_gateware': 'gateware',
+    'flash_softcpu_bios': 'bios',
+    'flash_softcpu_firmware': 'firmware',
+    'clear_softcpu_firmware': 'firmware',
+}
+
+
+def output_path(args, board):
+    """The --output file for the board."""
+    return args.output.replace('{port}', board.dev.port)
+
+
+def jtag_steps(args, board):
+    """OpenOCD steps for the JTAG operations requested."""
+    # Regions which share an erase sector (like the bios and firmware) are
+    # always programmed together, programming them one after the other
+    # would erase part of the first one.
+    compose = args.compose_image or boards.regions_share_sectors(
+        board.type,
+        [region for dest, region in COMPOSED_OPERATIONS.items()
+         if getattr(args, dest)])
+
+    steps = []
+    composed = False
+    for dest, step in JTAG_OPERATIONS:
+        value = getattr(args, dest)
+        if not value:
+            continue
 
-            if found_board:
-                board = found_board
-                break
+        if compose and dest in COMPOSED_OPERATIONS:
+            if not composed:
+                steps.append(boards.flash_composed_step(
+                    board,
+                    gateware=args.flash_gateware,
+                    bios=args.flash_softcpu_bios,
+                    firmware=args.flash_softcpu_firmware,
+                    clear_firmware=args.clear_softcpu_firmware,
+                    verbose=args.verbose,
+                    diff=args.diff_flash,
+                    verify=args.verify))
+                composed = True
+            continue
 
-            if (args.timeout and starttime - time.time() > args.timeout):
-                raise SystemError("Timeout!")
+        kwargs = {'verbose': args.verbose}
+        if dest.startswith(('flash_', 'clear_')):
+            kwargs['diff'] = args.diff_flash
+            kwargs['verify'] = args.verify
+
+        if dest == 'restore':
+            steps.extend(step(
+                board, value, verbose=args.verbose,
+                diff=args.diff_flash or 'cache', verify=args.verify))
+        elif dest == 'read_flash':
+            assert args.output, "--read-flash needs --output"
+            steps.append(step(
+                board, value, os.path.abspath(output_path(args, board)),
+                **kwargs))
+        elif dest == 'clear_softcpu_firmware':
+            steps.append(step(board, None, **kwargs))
+        elif value is True:
+            steps.append(step(board, **kwargs))
+        else:
+            steps.append(step(board, value, **kwargs))
+    return steps
+
+
+def operations_requested(args):
+    """Is anything going to be done to the boards?"""
+    return bool(
+        args.mode
+        or args.load_fx2_firmware
+        or args.flash_fx2_eeprom
+        or args.load_softcpu_firmware
+        or args.tune_jtag
+        or any(getattr(args, dest) for dest, _ in JTAG_OPERATIONS))
+
+
+# Operations done by loading firmware onto the FX2 (or through it), only one
+# of which can be done at a time.
+FX2_OPERATIONS = [
+    'load_fx2_firmware',
+    'flash_fx2_eeprom',
+    'load_softcpu_firmware',
+]
+
+
+def check_args(parser, args):
+    """Error out on combinations of operations which can't be done."""
+    fx2_ops = [dest for dest in FX2_OPERATIONS if getattr(args, dest)]
+    jtag_ops = [dest for dest, _ in JTAG_OPERATIONS if getattr(args, dest)]
+    if args.tune_jtag:
+        jtag_ops.insert(0, 'tune_jtag')
+    # The FX2 operations leave the board in a mode JTAG doesn't work in.
+    if len(fx2_ops) > 1 or (fx2_ops and jtag_ops):
+        parser.error("--{} can't be used with --{}".format(
+            fx2_ops[0].replace('_', '-'),
+            (fx2_ops[1:] + jtag_ops)[0].replace('_', '-')))
+
+    # Every board would write to the same file.
+    if args.all and args.read_flash and '{port}' not in (args.output or ''):
+        parser.error("--read-flash with --all needs {port} in --output")
+
+
+def board_pipeline(args, mode, board):
+    """Do everything asked for to one board, returning it afterwards."""
+    # Stop anything else touching the board until we are done with it.
+    with lock.BoardLock(board.dev.port) as held:
+        if held.waited:
+            # Whatever held the lock may have switched the board's mode,
+            # giving it a new device, so find it again.
+            found = boards.find_boards(
+                verbose=args.verbose, cached=True, ports=[board.dev.port])
+            assert len(found) == 1, (
+                "Board at {} went away: {}".format(board.dev.port, found))
+            board = found[0]
+        return _board_pipeline(args, mode, board)
+
+
+def _board_pipeline(args, mode, board):
+    # The mode-switch and manage-firmware commands will switch modes
+    # automatically.
+    if mode in ('mode-switch', 'manage-firmware'):
+        newmode = args.mode
+        if not newmode and (args.tune_jtag or any(
+                getattr(args, dest) for dest, _ in JTAG_OPERATIONS)):
+            newmode = 'jtag'
+
+        if newmode:
+            # Switch modes
+            board = switch_mode(args, board, newmode)
+
+    # Load firmware onto the fx2 (check_args stops these being combined with
+    # anything done over JTAG).
+    if args.load_fx2_firmware:
+        board = boards.load_fx2(
+            board, filename=args.load_fx2_firmware,
+            verbose=args.verbose, force=args.force)
+
+    # First, load DFU capable bootloader, then flash the firmware
+    elif args.flash_fx2_eeprom:
+        board = boards.load_fx2_dfu_bootloader(
+            board, verbose=args.verbose, force=args.force)
+        boards.flash_fx2(board, filename=args.flash_fx2_eeprom,
+                         verbose=args.verbose)
+
+    # Load firmware onto the SoftCPU inside the FPGA
+    elif args.load_softcpu_firmware:
+        if board.type == "opsis":
+            assert board.state == "serial"
+        assert board.tty
+        print("flterm something....")
+        raise NotImplemented("Not yet finished...")
 
-        if args.verbose:
-            sys.stderr.write("Board was {!r}\n".format(old_board))
-            sys.stderr.write("Board now {!r}\n".format(board))
+    # Everything else happens over JTAG, in a single OpenOCD run.
     else:
-        if args.verbose:
-            sys.stderr.write(
-                "Board already in required mode ({!s})\n".format(
-                    board.state))
+        if args.tune_jtag:
+            speed = boards.tune_jtag(board, verbose=args.verbose)
+            print("Using a JTAG speed of {} kHz".format(speed))
+
+        steps = jtag_steps(args, board)
+        if steps:
+            retry = boards.RetryPolicy(
+                attempts=args.retries,
+                backoff=args.retry_backoff,
+                reswitch=args.retry_reswitch)
+            boards.openocd_run(
+                board, steps, verbose=args.verbose, retry=retry)
 
     return board
 
 
+class BoardOutput(object):
+    """
+    Stands in for sys.stdout / sys.stderr while several boards are worked on
+    at once, putting the board each line came from in front of it.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def set_board(self, name):
+        self.local.name = name
+        self.local.pending = ""
+
+    def write(self, text):
+        name = getattr(self.local, 'name', None)
+        if name is None:
+            return self.stream.write(text)
+
+        lines = (self.local.pending + text).split("\n")
+        self.local.pending = lines.pop()
+        with self.lock:
+            for line in lines:
+                self.stream.write("[{}] {}\n".format(name, line))
+        return len(text)
+
+    def flush(self):
+        name = getattr(self.local, 'name', None)
+        if name is not None and self.local.pending:
+            self.write("\n")
+        self.stream.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+def run_all(args, mode, found_boards):
+    """
+    Run board_pipeline on all the boards at the same time (at most
+    args.jobs at once). One board failing doesn't stop the others.
+
+    Prints a summary at the end, and returns if all the boards worked.
+    """
+    stdout = BoardOutput(sys.stdout)
+    stderr = BoardOutput(sys.stderr)
+
+    def run(board):
+        stdout.set_board(board.dev.port)
+        stderr.set_board(board.dev.port)
+        starttime = time.time()
+        try:
+            board = board_pipeline(args, mode, board)
+            result = "ok"
+        except Exception as e:
+            sys.stderr.write("Failed: {!r}\n".format(e))
+            result = "FAILED: {}".format(str(e).split("\n")[0].strip())
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        return board, result, time.time() - starttime
+
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            results = list(pool.map(run, found_boards))
+    finally:
+        sys.stdout, sys.stderr = stdout.stream, stderr.stream
+
+    rows = [("Board", "Type", "State", "Time", "Result")]
+    for board, result, duration in results:
+        rows.append((
+            board.dev.port, board.type, str(board.state),
+            "{:.1f}s".format(duration), result))
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    for row in rows:
+        print("  ".join(
+            [c.ljust(w) for c, w in zip(row, widths)] + [row[-1]]))
+
+    return all(result == "ok" for _, result, _ in results)
+
+
 def main():
     # Parse the command line name
     cmd = os.path.basename(sys.argv[0])
@@ -272,17 +686,38 @@ def main():
     POSSIBLE_MODES = ['find-board', 'mode-switch', 'manage-firmware']
     boards.assert_in(mode, POSSIBLE_MODES)
 
-    args = args_parser(mode, board).parse_args()
+    parser = args_parser(mode, board)
+    args = parser.parse_args()
 
     if args.version:
+        from . import __version__
         print(__version__)
         return
 
+    lock.LOCK_TIMEOUT = args.lock_timeout
+
+    check_args(parser, args)
+
     if board != "hdmi2usb":
         args.by_type = board
     if args.by_type:
         boards.assert_in(args.by_type, boards.BOARD_TYPES)
 
+    if args.write_image:
+        assert args.by_type, "--write-image needs to know the board type"
+        image = boards.compose_image(
+            args.by_type,
+            gateware=args.flash_gateware,
+            bios=args.flash_softcpu_bios,
+            firmware=args.flash_softcpu_firmware,
+            start=0,
+            clear_firmware=args.clear_softcpu_firmware)
+        image.write(args.write_image)
+        if args.verbose:
+            sys.stderr.write("Wrote {} bytes to {}\n".format(
+                len(image), args.write_image))
+        return
+
     found_boards = find_boards(args)
     if not args.all:
         assert len(found_boards) == 1, found_boards
@@ -291,91 +726,27 @@ def main():
     if args.verbose:
         sys.stderr.write("My root dir: %s\n" % MYDIR)
 
-    # The mode-switch commands will switch modes automatically.
-    if mode == 'mode-switch':
-        assert len(found_boards) == 1
-        board = found_boards[0]
-
-        if not args.mode and (
-                args.load_gateware
-                or args.flash_gateware
-                or args.reset_gateware
-                or args.flash_softcpu_bios
-                or args.flash_softcpu_firmware
-                or args.clear_softcpu_firmware
-                or args.flash_image):
-            args.mode = 'jtag'
-
-        # FIXME: Hack to work around issue on the FX2.
-        # if args.mode == 'jtag' and board.type == 'opsis':
-        #     board = switch_mode(args, board, 'serial')
-        #     board = switch_mode(args, board, 'jtag')
-        #     board = switch_mode(args, board, 'serial')
-
-        if args.mode:
-            # Switch modes
-            board = switch_mode(args, board, args.mode)
+    if not operations_requested(args):
+        pass
+    elif not args.all:
+        board_pipeline(args, mode, found_boards[0])
+    elif not run_all(args, mode, found_boards):
+        sys.exit(1)
 
     found_boards = find_boards(args)
-    for board in found_boards:
-        # Load firmware onto the fx2
-        if args.load_fx2_firmware:
-            boards.load_fx2(
-                board, filename=args.load_fx2_firmware,
-                verbose=args.verbose)
-
-        # First, load DFU capable bootloader, then flash the firmware
-        elif args.flash_fx2_eeprom:
-            board = boards.load_fx2_dfu_bootloader(board, verbose=args.verbose)
-            boards.flash_fx2(board, filename=args.flash_fx2_eeprom,
-                             verbose=args.verbose)
-
-        # Load gateware onto the FPGA
-        elif args.load_gateware:
-            boards.load_gateware(
-                board, args.load_gateware, verbose=args.verbose)
-
-        # Flash the gateware into the SPI flash on the board.
-        elif args.flash_gateware:
-            boards.flash_gateware(
-                board, args.flash_gateware, verbose=args.verbose)
-
-        # Reset the gateware running on the board.
-        elif args.reset_gateware:
-            boards.reset_gateware(
-                board, verbose=args.verbose)
-
-        # Flash the gateware into the SPI flash on the board.
-        elif args.flash_softcpu_bios:
-            boards.flash_bios(
-                board, args.flash_softcpu_bios, verbose=args.verbose)
-
-        # Load firmware onto the SoftCPU inside the FPGA
-        elif args.load_softcpu_firmware:
-            if board.type == "opsis":
-                assert board.state == "serial"
-            assert board.tty
-            print("flterm something....")
-            raise NotImplemented("Not yet finished...")
-
-        # Flash the firmware into the SPI flash on the board.
-        elif args.flash_softcpu_firmware:
-            boards.flash_firmware(
-                board, args.flash_softcpu_firmware, verbose=args.verbose)
-
-        # Clear the firmware into the SPI flash on the board.
-        elif args.clear_softcpu_firmware:
-            boards.flash_firmware(
-                board, filename=None, verbose=args.verbose)
-
-        # Flash an image with gateware+bios+firmware into the SPI flash on the
-        # board.
-        elif args.flash_image:
-            boards.flash_image(
-                board, args.flash_image, verbose=args.verbose)
 
-    found_boards = find_boards(args)
+    # Wait for anything else changing the boards to finish before reporting
+    # on them.
+    with contextlib.ExitStack() as stack:
+        locks = [
+            stack.enter_context(lock.BoardLock(board.dev.port, shared=True))
+            for board in found_boards]
+        if any(held.waited for held in locks):
+            found_boards = find_boards(args)
+        report_boards(args, found_boards)
+
 
+def report_boards(args, found_boards):
     for board in found_boards:
         if not (args.get_usbfs
                 or args.get_sysfs
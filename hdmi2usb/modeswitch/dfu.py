@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+USB Device Firmware Upgrade (DFU 1.1) download client using libusb, rather
+than running `dfu-util`.
+
+Unlike dfu-util this always talks to one exact device, so several boards can
+be flashed at the same time.
+"""
+
+import binascii
+import struct
+import time
+
+import usb.core
+import usb.util
+
+
+# Interface class / subclass of a DFU interface.
+DFU_CLASS = 0xFE
+DFU_SUBCLASS = 0x01
+
+# Descriptor type of the DFU functional descriptor.
+DFU_FUNCTIONAL = 0x21
+
+# Class requests to the interface, host to device / device to host.
+CTRL_OUT = 0x21
+CTRL_IN = 0xA1
+
+DFU_DNLOAD = 1
+DFU_GETSTATUS = 3
+DFU_CLRSTATUS = 4
+DFU_ABORT = 6
+
+# bState values
+STATE_DFU_IDLE = 2
+STATE_DFU_DNLOAD_SYNC = 3
+STATE_DFU_DNBUSY = 4
+STATE_DFU_DNLOAD_IDLE = 5
+STATE_DFU_MANIFEST_SYNC = 6
+STATE_DFU_MANIFEST = 7
+STATE_DFU_MANIFEST_WAIT_RESET = 8
+STATE_DFU_ERROR = 10
+
+# bStatus values
+STATUS_OK = 0
+
+
+class DFUError(Exception):
+    """The device reported an error (or went away) during a download."""
+
+    def __init__(self, msg, status=None, state=None, offset=None):
+        self.status = status
+        self.state = state
+        self.offset = offset
+        if status is not None:
+            msg += " (status {}, state {})".format(status, state)
+        if offset is not None:
+            msg += " at offset {}".format(offset)
+        Exception.__init__(self, msg)
+
+
+class DFUFile(object):
+    """
+    DFU (.dfu) file.
+
+    Generate with something like;
+        dfu-suffix -v 2a19 -p 5441 -a firmware.bin
+
+    Consists of;
+     * File Data - bytes
+     * Suffix    - 16 bytes
+       * bcdDevice - 16bits
+       * idProduct - 16bits
+       * idVendor  - 16bits
+       * bcdDFU    - 16bits
+       * ucDfuSig  - "UFD"
+       * bLength   - 8bits (16)
+       * dwCRC     - 32bits, CRC32 of everything before it
+    """
+    suffix = struct.Struct(
+        "<"   # little endian
+        "H"   # bcdDevice
+        "H"   # idProduct
+        "H"   # idVendor
+        "H"   # bcdDFU
+        "3s"  # ucDfuSig
+        "B"   # bLength
+        "I"   # dwCRC
+    )
+
+    def __init__(self, filename):
+        try:
+            assert filename.endswith('.dfu'), "Filename should end in .dfu"
+            with open(filename, 'rb') as f:
+                data = f.read()
+            assert len(data) >= self.suffix.size, "File too short"
+
+            (self.did, self.pid, self.vid, bcddfu, sig, length,
+             crc) = self.suffix.unpack_from(data, len(data) - self.suffix.size)
+            assert sig == b'UFD', "No DFU suffix found"
+            assert length == self.suffix.size, length
+
+            # dfu-util doesn't do the final inversion of the CRC.
+            ccrc = binascii.crc32(data[:-4]) ^ 0xFFFFFFFF
+            assert crc == ccrc, "CRC 0x{:08x} != 0x{:08x}".format(crc, ccrc)
+
+            self.data = data[:-length]
+        except AssertionError as e:
+            raise TypeError(e)
+
+    def __str__(self):
+        return "{}(len={}, {:04x}:{:04x}:{:04x})".format(
+            self.__class__.__name__, len(self.data), self.vid, self.pid,
+            self.did)
+
+
+def find_interface(dev):
+    """Find the DFU interface and its wTransferSize."""
+    config = dev.get_active_configuration()
+    for intf in config:
+        if intf.bInterfaceClass != DFU_CLASS:
+            continue
+        if intf.bInterfaceSubClass != DFU_SUBCLASS:
+            continue
+
+        extra = bytes(intf.extra_descriptors)
+        while len(extra) >= 2:
+            length, dtype = extra[0], extra[1]
+            if dtype == DFU_FUNCTIONAL and length >= 7:
+                # bmAttributes, wDetachTimeOut, wTransferSize
+                _, _, transfer_size = struct.unpack_from('<BHH', extra, 2)
+                return intf, transfer_size
+            if length == 0:
+                break
+            extra = extra[length:]
+
+        raise DFUError("DFU interface without a functional descriptor")
+    raise DFUError("No DFU interface found on {}".format(dev))
+
+
+def get_status(dev, intf):
+    """Returns (bStatus, bwPollTimeout in seconds, bState)."""
+    data = bytes(dev.ctrl_transfer(
+        CTRL_IN, DFU_GETSTATUS, 0, intf.bInterfaceNumber, 6))
+    status, poll_lo, poll_hi, state = struct.unpack_from('<BHBB', data)
+    return status, (poll_lo | (poll_hi << 16)) / 1000.0, state
+
+
+def _wait_idle(dev, intf, offset, prepare=None):
+    """
+    Poll the status until the device has finished with the last block.
+
+    While waiting out bwPollTimeout, prepare() is called to get the next block
+    ready so the device isn't kept waiting on us.
+    """
+    prepared = None
+    while True:
+        status, poll_timeout, state = get_status(dev, intf)
+        if status != STATUS_OK or state == STATE_DFU_ERROR:
+            dev.ctrl_transfer(
+                CTRL_OUT, DFU_CLRSTATUS, 0, intf.bInterfaceNumber, None)
+            raise DFUError("Download failed", status, state, offset)
+        if state in (STATE_DFU_DNLOAD_IDLE, STATE_DFU_IDLE,
+                     STATE_DFU_MANIFEST_WAIT_RESET):
+            return state, prepared
+
+        deadline = time.time() + poll_timeout
+        if prepare is not None and prepared is None:
+            prepared = prepare()
+        remaining = deadline - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def download(dev, data, progress=None, transfer_size=None):
+    """
+    Download data to the DFU device.
+
+    The data is sent in blocks of the device's advertised wTransferSize.
+    progress(sent, total) is called after each block.
+    """
+    intf, advertised_size = find_interface(dev)
+    if transfer_size is None:
+        transfer_size = advertised_size
+    assert transfer_size > 0, transfer_size
+
+    usb.util.claim_interface(dev, intf)
+    try:
+        if intf.bAlternateSetting:
+            dev.set_interface_altsetting(intf)
+
+        # Make sure we are starting from dfuIDLE.
+        status, _, state = get_status(dev, intf)
+        if state == STATE_DFU_ERROR:
+            dev.ctrl_transfer(
+                CTRL_OUT, DFU_CLRSTATUS, 0, intf.bInterfaceNumber, None)
+        elif state != STATE_DFU_IDLE:
+            dev.ctrl_transfer(
+                CTRL_OUT, DFU_ABORT, 0, intf.bInterfaceNumber, None)
+
+        data = memoryview(data)
+        total = len(data)
+        block = data[:transfer_size]
+        blocknum = 0
+        offset = 0
+        while len(block) > 0:
+            try:
+                dev.ctrl_transfer(
+                    CTRL_OUT, DFU_DNLOAD, blocknum, intf.bInterfaceNumber,
+                    block)
+            except usb.core.USBError as e:
+                raise DFUError("DNLOAD failed: {}".format(e), offset=offset)
+            sent = offset + len(block)
+
+            def next_block(start=sent):
+                return data[start:start + transfer_size]
+            _, block = _wait_idle(dev, intf, offset, next_block)
+            if block is None:
+                block = next_block()
+
+            offset = sent
+            blocknum = (blocknum + 1) & 0xFFFF
+            if progress is not None:
+                progress(offset, total)
+
+        # A zero length download starts the manifestation phase.
+        dev.ctrl_transfer(
+            CTRL_OUT, DFU_DNLOAD, blocknum, intf.bInterfaceNumber, None)
+        try:
+            _wait_idle(dev, intf, offset)
+        except usb.core.USBError:
+            # Devices which aren't manifestation tolerant reset themselves.
+            pass
+    finally:
+        try:
+            usb.util.release_interface(dev, intf)
+        except usb.core.USBError:
+            pass
+
+
+def download_file(dev, filename, progress=None):
+    """Download a .dfu file, checking it is for this device."""
+    dfufile = DFUFile(filename)
+    if dfufile.vid != 0xFFFF and dfufile.vid != dev.idVendor:
+        raise DFUError("{} is for vendor 0x{:04x} not 0x{:04x}".format(
+            filename, dfufile.vid, dev.idVendor))
+    if dfufile.pid != 0xFFFF and dfufile.pid != dev.idProduct:
+        raise DFUError("{} is for product 0x{:04x} not 0x{:04x}".format(
+            filename, dfufile.pid, dev.idProduct))
+    download(dev, dfufile.data, progress=progress)
@@ -5,14 +5,30 @@
 Functions for examining different file types.
 """
 
-import struct
 import binascii
+import hashlib
+import logging
+import os
+import pickle
+import struct
+import tempfile
+
+from . import cache
 
 
 def assert_eq(a, b):
     assert a == b, "'%s' (%r) != '%s' (%r)" % (a, a, b, b)
 
 
+def file_digest(filename):
+    """sha256 hex digest of the contents of a file."""
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
 class FlashBootImageFile(object):
     """
     FlashBootImage (.fbi) file.
@@ -170,6 +186,135 @@ class XilinxBinFile(object):
             raise TypeError("File doesn't start with required header.")
 
 
+class IntelHexFile(object):
+    """
+    Intel HEX (.hex, .ihx, .ihex) file.
+
+    Used for the firmware loaded into the RAM of the Cypress FX2.
+
+    Each line is a record of the form;
+        :LLAAAATTDD...DDCC
+
+     * LL   - Number of data bytes
+     * AAAA - Address (big endian)
+     * TT   - Record type (00 data, 01 end of file, 02/04 extended address,
+              03/05 start address)
+     * DD   - Data bytes
+     * CC   - Checksum, two's complement of the sum of all the other bytes
+
+    The data records are merged into contiguous (address, bytes) segments.
+
+    Use IntelHexFile.cached(filename) to reuse segments which have already
+    been parsed, in this process or a previous one.
+    """
+    record = struct.Struct(
+        ">"   # big endian
+        "B"   # length
+        "H"   # address
+        "B"   # type
+    )
+
+    def __init__(self, filename):
+        try:
+            records = []
+            base = 0
+            with open(filename, 'r') as f:
+                for lineno, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    assert line.startswith(':'), (
+                        "Line {} doesn't start with ':'".format(lineno))
+                    raw = binascii.unhexlify(line[1:])
+                    length, address, rtype = self.record.unpack_from(raw)
+                    data = raw[self.record.size:-1]
+                    assert_eq(len(data), length)
+                    assert (sum(raw) & 0xff) == 0, (
+                        "Bad checksum on line {}".format(lineno))
+
+                    if rtype == 0x00:
+                        records.append((base + address, data))
+                    elif rtype == 0x01:
+                        break
+                    elif rtype == 0x02:
+                        base = int.from_bytes(data, 'big') << 4
+                    elif rtype == 0x04:
+                        base = int.from_bytes(data, 'big') << 16
+                    elif rtype in (0x03, 0x05):
+                        pass
+                    else:
+                        assert False, (
+                            "Unknown record type {} on line {}".format(
+                                rtype, lineno))
+        except (AssertionError, binascii.Error, struct.error) as e:
+            raise TypeError(e)
+
+        self.segments = self.merge(records)
+
+    # (realpath, size, mtime) -> IntelHexFile
+    _memo = {}
+
+    @classmethod
+    def cached(cls, filename):
+        st = os.stat(filename)
+        key = (os.path.realpath(filename), st.st_size, st.st_mtime_ns)
+        if key in cls._memo:
+            return cls._memo[key]
+
+        digest = file_digest(filename)
+        keyhash = hashlib.sha256(
+            repr(key + (digest,)).encode('utf-8')).hexdigest()
+        cachefile = cache.cache_path('ihex', keyhash + '.pickle')
+
+        hexfile = None
+        try:
+            with open(cachefile, 'rb') as f:
+                cached_key, segments = pickle.load(f)
+            if cached_key == key + (digest,):
+                hexfile = cls.__new__(cls)
+                hexfile.segments = segments
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            pass
+
+        if hexfile is None:
+            hexfile = cls(filename)
+            try:
+                with tempfile.NamedTemporaryFile(
+                        dir=os.path.dirname(cachefile), suffix='.tmp',
+                        delete=False) as f:
+                    pickle.dump((key + (digest,), hexfile.segments), f)
+                os.replace(f.name, cachefile)
+            except OSError as e:
+                logging.debug("Unable to cache %s: %s", filename, e)
+
+        cls._memo[key] = hexfile
+        return hexfile
+
+    @staticmethod
+    def merge(records):
+        segments = []
+        for address, data in sorted(records):
+            if segments:
+                last_address, last_data = segments[-1]
+                end = last_address + len(last_data)
+                if address < end:
+                    raise TypeError(
+                        "Overlapping records at 0x{:04x}".format(address))
+                if address == end:
+                    last_data += data
+                    continue
+            segments.append((address, bytearray(data)))
+        return [(address, bytes(data)) for address, data in segments]
+
+    def __len__(self):
+        return sum(len(data) for _, data in self.segments)
+
+    def __str__(self):
+        return "{}(segments=[{}])".format(
+            self.__class__.__name__, ", ".join(
+                "0x{:04x}+{}".format(a, len(d)) for a, d in self.segments))
+
+
 if __name__ == "__main__":
     import sys
     fname = sys.argv[1]
@@ -179,5 +324,7 @@ if __name__ == "__main__":
         print(XilinxBitFile(fname))
     elif fname.endswith('.fbi'):
         print(FlashBootImageFile(fname))
+    elif fname.endswith(('.hex', '.ihx', '.ihex')):
+        print(IntelHexFile(fname))
     else:
         sys.exit(1)
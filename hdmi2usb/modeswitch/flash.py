@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Work out which parts of the SPI flash actually need rewriting.
+
+The flash is compared in chunks which never cross an erase sector boundary.
+What is currently in the flash comes either from reading it back or from the
+record of what was last written to the board, which is kept as a hash per
+chunk.
+"""
+
+import contextlib
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+from . import cache
+
+
+# Size of the erase sectors jtagspi uses.
+SECTOR_SIZE = 0x10000
+
+
+def chunks(start, length, sector_size=SECTOR_SIZE):
+    """Split start..start+length into (offset, size) at sector boundaries."""
+    offset = start
+    end = start + length
+    while offset < end:
+        size = min(end, (offset // sector_size + 1) * sector_size) - offset
+        yield offset, size
+        offset += size
+
+
+def chunk_hashes(data, start, sector_size=SECTOR_SIZE):
+    """{offset: [size, sha1]} for the data being written at start."""
+    data = memoryview(data)
+    hashes = {}
+    for offset, size in chunks(start, len(data), sector_size):
+        chunk = data[offset - start:offset - start + size]
+        hashes[offset] = [size, hashlib.sha1(chunk).hexdigest()]
+    return hashes
+
+
+def _runs(changed):
+    """Merge a sorted list of (offset, size) into contiguous runs."""
+    runs = []
+    for offset, size in changed:
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1] = (runs[-1][0], runs[-1][1] + size)
+        else:
+            runs.append((offset, size))
+    return runs
+
+
+def changed_runs(data, start, current, sector_size=SECTOR_SIZE):
+    """
+    Runs of (offset, size) where data (to be written at start) differs from
+    what is in the flash.
+
+    current is either the bytes read back from start..start+len(data), or
+    {offset: [size, sha1]} from chunk_hashes() for what was last written.
+    """
+    data = memoryview(data)
+    changed = []
+    if isinstance(current, dict):
+        new = chunk_hashes(data, start, sector_size)
+        for offset in sorted(new):
+            if current.get(offset) != new[offset]:
+                changed.append((offset, new[offset][0]))
+    else:
+        current = memoryview(current)
+        for offset, size in chunks(start, len(data), sector_size):
+            i = offset - start
+            # memoryview comparison is a single memcmp per chunk.
+            if current[i:i + size] != data[i:i + size]:
+                changed.append((offset, size))
+    return _runs(changed)
+
+
+def read_mapped(filename):
+    """Read only, memory mapped view of a file (b'' when it is empty)."""
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def first_mismatch(a, b, chunk_size=0x100000):
+    """
+    Offset of the first byte which differs between a and b (or where the
+    shorter one ends), None when they are the same.
+
+    Compares a chunk at a time and then halves the first differing chunk
+    until the byte is found, so every comparison is a memcmp.
+    """
+    a = memoryview(a)
+    b = memoryview(b)
+    length = min(len(a), len(b))
+    for start in range(0, length, chunk_size):
+        end = min(start + chunk_size, length)
+        if a[start:end] == b[start:end]:
+            continue
+        while end - start > 1:
+            middle = (start + end) // 2
+            if a[start:middle] != b[start:middle]:
+                end = middle
+            else:
+                start = middle
+        return start
+    if len(a) != len(b):
+        return length
+    return None
+
+
+def compare_files(expected, actual):
+    """first_mismatch() between two files, using memory mapped files."""
+    return first_mismatch(read_mapped(expected), read_mapped(actual))
+
+
+_tmpdir = None
+_tmpdir_lock = threading.Lock()
+
+
+def tmp_path(name, owner=None):
+    """
+    Path for a file which is removed when the program exits.
+
+    Files for different owners (like the USB port of the board they are
+    for) go in different directories, so boards worked on at the same time
+    never share files.
+    """
+    global _tmpdir
+    with _tmpdir_lock:
+        if _tmpdir is None:
+            _tmpdir = tempfile.TemporaryDirectory(prefix='hdmi2usb-')
+    if owner is None:
+        return os.path.join(_tmpdir.name, name)
+    directory = os.path.join(
+        _tmpdir.name, re.sub(r'[^A-Za-z0-9.-]+', '_', owner))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+def write_runs(data, start, runs, prefix, owner=None):
+    """Write each run of data out to a file, returning [(path, offset)]."""
+    data = memoryview(data)
+    parts = []
+    for offset, size in runs:
+        path = tmp_path("{}-{:08x}.bin".format(prefix, offset), owner)
+        with open(path, 'wb') as f:
+            f.write(data[offset - start:offset - start + size])
+        parts.append((path, offset))
+    return parts
+
+
+class FlashImage(object):
+    """
+    Files placed at offsets in the flash, as one image padded with 0xff.
+
+    The image is only ever produced a chunk at a time, it is never held in
+    memory as a whole.
+    """
+    PAD = b'\xff'
+
+    def __init__(self, parts, start=None):
+        """parts is a list of (offset, filename)."""
+        self.parts = []
+        end = None
+        for offset, filename in sorted(parts):
+            size = os.path.getsize(filename)
+            if end is not None and offset < end:
+                raise ValueError(
+                    "{} at 0x{:x} overlaps the part before it".format(
+                        filename, offset))
+            self.parts.append((offset, size, filename))
+            end = offset + size
+
+        if start is None:
+            start = self.parts[0][0]
+        assert start <= self.parts[0][0], (start, self.parts)
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def chunks(self, chunk_size=SECTOR_SIZE):
+        """Generate the image as chunks of at most chunk_size bytes."""
+        position = self.start
+        for offset, size, filename in self.parts:
+            while position < offset:
+                length = min(chunk_size, offset - position)
+                yield self.PAD * length
+                position += length
+            with open(filename, 'rb') as f:
+                while True:
+                    data = f.read(chunk_size)
+                    if not data:
+                        break
+                    yield data
+            position += size
+
+    def write(self, filename):
+        with open(filename, 'wb') as f:
+            for data in self.chunks():
+                f.write(data)
+        return filename
+
+
+class WrittenRecord(object):
+    """
+    Hashes of what was last written to each chunk of a board's flash,
+    stored in the cache directory.
+
+    key has to identify the board itself (its Device DNA), not just where
+    it is plugged in.
+    """
+
+    def __init__(self, key, path=None, sector_size=SECTOR_SIZE):
+        if path is None:
+            name = re.sub(r'[^A-Za-z0-9.-]+', '_', key)
+            path = cache.cache_path('flash', name + '.json')
+        self.path = path
+        self.sector_size = sector_size
+
+    def load(self):
+        stored = cache.load_json(self.path, {})
+        return dict((int(offset, 16), v) for offset, v in stored.items())
+
+    def known(self, start, length):
+        """Hashes for start..start+length, or None if any chunk is unknown."""
+        stored = self.load()
+        hashes = {}
+        for offset, size in chunks(start, length, self.sector_size):
+            if offset not in stored or stored[offset][0] != size:
+                return None
+            hashes[offset] = stored[offset]
+        return hashes
+
+    @contextlib.contextmanager
+    def _updating(self):
+        with cache.updating_json(self.path, {}) as stored:
+            hashes = dict((int(offset, 16), v) for offset, v in stored.items())
+            yield hashes
+            stored.clear()
+            stored.update(
+                ("0x{:08x}".format(offset), v) for offset, v in hashes.items())
+
+    def _drop(self, stored, start, length):
+        first = start // self.sector_size
+        last = (start + length - 1) // self.sector_size
+        for offset in list(stored):
+            if first <= offset // self.sector_size <= last:
+                del stored[offset]
+
+    def record(self, data, start, erased=True):
+        """
+        Record data as being in the flash at start.
+
+        erased is False when the data was read from the flash, rather than
+        written (which erases every sector it touches).
+        """
+        with self._updating() as stored:
+            if erased:
+                self._drop(stored, start, len(data))
+            stored.update(chunk_hashes(data, start, self.sector_size))
+
+    def drop(self, start, length):
+        """
+        Forget what is in every sector start..start+length touches, before
+        they are erased.
+        """
+        with self._updating() as stored:
+            self._drop(stored, start, length)
+
+    def forget(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Load firmware into the RAM of a Cypress FX2 using libusb, rather than running
+`fxload -t fx2lp`.
+
+The firmware is written with the "Firmware Load" vendor request (0xA0) which
+is handled by the FX2 itself, so it works no matter what firmware is currently
+running. The CPU is held in reset (via the CPUCS register) while the RAM is
+written and then released to start the new firmware.
+"""
+
+import usb.core
+
+from . import files
+
+
+# Vendor request handled by the FX2 core for reading / writing RAM.
+FX2_FIRMWARE_LOAD = 0xA0
+
+# CPU control and status register, bit 0 holds the 8051 in reset.
+FX2_CPUCS = 0xE600
+
+# Largest control transfer the FX2 (and Linux usbfs) will accept.
+FX2_MAX_TRANSFER = 4096
+
+# RAM which can be written with the 0xA0 request.
+FX2_RAM = (
+    (0x0000, 0x4000),  # Main program / data RAM (16k on the FX2LP)
+    (0xE000, 0xE200),  # Scratch RAM
+)
+
+# Vendor request to the device, host to device / device to host.
+CTRL_OUT = 0x40
+CTRL_IN = 0xC0
+
+
+class FX2LoadError(Exception):
+    """
+    Loading firmware onto the FX2 failed.
+
+     * stage   - 'reset', 'write', 'verify' or 'range'
+     * address - Address of the transfer which failed (if any)
+     * length  - Length of the transfer which failed (if any)
+     * error   - The underlying USBError (if any)
+    """
+
+    def __init__(self, stage, address=None, length=None, error=None):
+        self.stage = stage
+        self.address = address
+        self.length = length
+        self.error = error
+        Exception.__init__(self, str(self))
+
+    def as_dict(self):
+        return {
+            'stage': self.stage,
+            'address': self.address,
+            'length': self.length,
+            'error': None if self.error is None else str(self.error),
+        }
+
+    def __str__(self):
+        s = "FX2 firmware load failed during {}".format(self.stage)
+        if self.address is not None:
+            s += " at 0x{:04x}".format(self.address)
+        if self.length is not None:
+            s += " ({} bytes)".format(self.length)
+        if self.error is not None:
+            s += ": {}".format(self.error)
+        return s
+
+
+def find_device(path):
+    """Find the pyusb device at the given base.Path."""
+    dev = usb.core.find(bus=path.bus, address=path.address)
+    assert dev is not None, "No USB device at {}".format(path)
+    return dev
+
+
+def write_ram(dev, address, data, timeout=1000):
+    return dev.ctrl_transfer(
+        CTRL_OUT, FX2_FIRMWARE_LOAD, address, 0, data, timeout)
+
+
+def read_ram(dev, address, length, timeout=1000):
+    return bytes(dev.ctrl_transfer(
+        CTRL_IN, FX2_FIRMWARE_LOAD, address, 0, length, timeout))
+
+
+def set_reset(dev, hold):
+    try:
+        write_ram(dev, FX2_CPUCS, b'\x01' if hold else b'\x00')
+    except usb.core.USBError as e:
+        if hold:
+            raise FX2LoadError('reset', FX2_CPUCS, 1, e)
+        # Releasing reset starts the new firmware, which often disconnects
+        # and re-enumerates before the request completes.
+
+
+def check_ram(segments):
+    for address, data in segments:
+        for start, end in FX2_RAM:
+            if start <= address and address + len(data) <= end:
+                break
+        else:
+            raise FX2LoadError('range', address, len(data))
+
+
+def load_ram(dev, segments, verify=False, max_transfer=FX2_MAX_TRANSFER):
+    """
+    Write the (address, bytes) segments into the FX2 RAM and start it.
+
+    Each segment is written in transfers of up to max_transfer bytes. With
+    verify, each transfer is read back and compared before moving on.
+    """
+    check_ram(segments)
+
+    set_reset(dev, True)
+    for address, data in segments:
+        for offset in range(0, len(data), max_transfer):
+            chunk = data[offset:offset + max_transfer]
+            chunk_address = address + offset
+            try:
+                write_ram(dev, chunk_address, chunk)
+                if verify and read_ram(
+                        dev, chunk_address, len(chunk)) != chunk:
+                    raise FX2LoadError('verify', chunk_address, len(chunk))
+            except usb.core.USBError as e:
+                raise FX2LoadError('write', chunk_address, len(chunk), e)
+    set_reset(dev, False)
+
+
+def load_file(dev, filename, verify=False):
+    """Load an Intel HEX firmware file onto the FX2."""
+    hexfile = files.IntelHexFile.cached(filename)
+    load_ram(dev, hexfile.segments, verify=verify)
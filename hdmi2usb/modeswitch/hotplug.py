@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Registry of USB devices (and the boards they belong to) which is kept up to
+date from kernel hotplug events rather than by rescanning the whole bus.
+
+Events are read from a NETLINK_KOBJECT_UEVENT socket. When that isn't
+available (for example inside containers) the registry falls back to polling
+sysfs. Tests can feed events in by hand with a QueueEventSource.
+
+This will only run on Linux.
+"""
+
+import logging
+import queue
+import re
+import select
+import socket
+import time
+
+from . import sysfs
+
+
+NETLINK_KOBJECT_UEVENT = 15
+# Multicast group the kernel sends uevents to (udev uses group 2).
+UEVENT_GROUP_KERNEL = 1
+
+# 1-1.3.1 or 1-1.3.1:1.0 or usb1
+SYSFS_NAME_REGEX = re.compile(r"^(usb[0-9]+|[0-9]+-[0-9.]+)(:[0-9.]+)?$")
+
+
+def parse_uevent(data):
+    """
+    Parse a raw kernel uevent message into a dictionary.
+
+    'add@/devices/...\\0ACTION=add\\0DEVPATH=/devices/...\\0SUBSYSTEM=usb\\0'
+    """
+    parts = data.split(b'\0')
+    if b'@' not in parts[0]:
+        # Not a kernel message (messages from udev start with "libudev").
+        return None
+
+    event = {}
+    for part in parts[1:]:
+        if b'=' not in part:
+            continue
+        key, value = part.decode('utf-8', 'replace').split('=', 1)
+        event[key] = value
+    return event
+
+
+def device_name(devpath):
+    """Find the sysfs name of the USB device a uevent DEVPATH is under."""
+    for component in reversed(devpath.split('/')):
+        m = SYSFS_NAME_REGEX.match(component)
+        if m:
+            return m.group(1)
+    return None
+
+
+class NetlinkEventSource(object):
+    """Uevents read straight from the kernel."""
+
+    def __init__(self):
+        self.sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            self.sock.bind((0, UEVENT_GROUP_KERNEL))
+        except OSError:
+            self.sock.close()
+            raise
+
+    def read(self, timeout):
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        events = []
+        while readable:
+            try:
+                data = self.sock.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            event = parse_uevent(data)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self):
+        self.sock.close()
+
+
+class QueueEventSource(object):
+    """Uevents pushed in by hand, used for testing."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def push(self, **event):
+        self.queue.put(event)
+
+    def read(self, timeout):
+        events = []
+        try:
+            events.append(self.queue.get(timeout=timeout))
+            while True:
+                events.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+    def close(self):
+        pass
+
+
+class PollingEventSource(object):
+    """
+    Fallback which rescans sysfs and turns the differences into uevents.
+
+    If ports is given only those devices are rescanned.
+    """
+
+    def __init__(self, interval=0.1, ports=None):
+        self.interval = interval
+        self.ports = ports
+        self.known = self._scan()
+
+    def _scan(self):
+        snapshot = sysfs.SysfsSnapshot.take(names=self.ports)
+        return {
+            name: (attrs['busnum'], attrs['devnum'])
+            for name, attrs in snapshot.devices.items()}
+
+    def read(self, timeout):
+        if timeout is not None:
+            time.sleep(min(timeout, self.interval))
+        else:
+            time.sleep(self.interval)
+
+        current = self._scan()
+        events = []
+        for name, ident in sorted(self.known.items()):
+            if current.get(name) != ident:
+                events.append(dict(
+                    ACTION='remove', DEVPATH=name, SUBSYSTEM='usb',
+                    DEVTYPE='usb_device'))
+        for name, ident in sorted(current.items()):
+            if self.known.get(name) != ident:
+                events.append(dict(
+                    ACTION='add', DEVPATH=name, SUBSYSTEM='usb',
+                    DEVTYPE='usb_device'))
+        self.known = current
+        return events
+
+    def close(self):
+        pass
+
+
+def default_event_source(ports=None):
+    try:
+        return NetlinkEventSource()
+    except (AttributeError, OSError) as e:
+        logging.info("Netlink uevents not available (%s), polling instead.", e)
+        return PollingEventSource(ports=ports)
+
+
+class HotplugRegistry(object):
+    """
+    Incrementally maintained map of the USB devices (and boards) on the
+    system, keyed by the sysfs name of the port the device is plugged into
+    (such as '3-1.4').
+
+    If ports is given only the devices plugged into those ports are kept
+    track of, and nothing else on the bus is ever read.
+
+    Use as a context manager;
+
+        with HotplugRegistry(classify=boards.classify_device) as registry:
+            ...
+            board = registry.wait_for(lambda r: r.boards.get('3-1.4'), 5)
+    """
+
+    def __init__(self, source=None, classify=None, resync_interval=1.0,
+                 ports=None):
+        self.source = source
+        self.classify = classify
+        self.ports = ports
+        # The kernel only sends uevents to the initial network namespace, so
+        # even with a working socket we occasionally rescan (polling already
+        # rescans all the time).
+        self.resync_interval = resync_interval
+
+        self.devices = {}
+        self.boards = {}
+        self.callbacks = {'add': [], 'remove': [], 'change': []}
+
+    def open(self):
+        # Subscribe before the initial scan so nothing is missed in between.
+        if self.source is None:
+            self.source = default_event_source(self.ports)
+        self.resync()
+        return self
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def on_add(self, callback):
+        self.callbacks['add'].append(callback)
+
+    def on_remove(self, callback):
+        self.callbacks['remove'].append(callback)
+
+    def on_change(self, callback):
+        self.callbacks['change'].append(callback)
+
+    def _notify(self, action, name, device, board):
+        for callback in self.callbacks[action]:
+            callback(name, device, board)
+
+    def _set(self, name, device):
+        old_device = self.devices.get(name)
+        old_board = self.boards.get(name)
+
+        if old_device is not None and (
+                device is None or old_device.path != device.path):
+            del self.devices[name]
+            self.boards.pop(name, None)
+            self._notify('remove', name, old_device, old_board)
+            old_device = None
+
+        if device is None:
+            return
+
+        board = None
+        if self.classify is not None:
+            board = self.classify(device)
+
+        self.devices[name] = device
+        if board is not None:
+            self.boards[name] = board
+        else:
+            self.boards.pop(name, None)
+
+        if old_device is None:
+            self._notify('add', name, device, board)
+        elif (old_device, old_device.drivers(), old_device.tty()) != (
+                device, device.drivers(), device.tty()):
+            self._notify('change', name, device, board)
+
+    def update(self, name):
+        """Re-read a single device from sysfs."""
+        snapshot = sysfs.SysfsSnapshot.take(names=[name])
+        devices = sysfs.find_usb_devices(snapshot)
+        self._set(name, devices[0] if devices else None)
+
+    def resync(self):
+        """
+        Rescan the bus (or just the ports), used when events may have been
+        missed.
+        """
+        snapshot = sysfs.SysfsSnapshot.take(names=self.ports)
+        devices = {d.port: d for d in sysfs.find_usb_devices(snapshot)}
+        for name in sorted(set(self.devices) - set(devices)):
+            self._set(name, None)
+        for name, device in sorted(devices.items()):
+            self._set(name, device)
+        self.last_resync = time.time()
+
+    def handle(self, event):
+        if event.get('SUBSYSTEM') not in ('usb', 'tty'):
+            return
+
+        name = device_name(event.get('DEVPATH', ''))
+        if name is None:
+            return
+        if self.ports is not None and name not in self.ports:
+            return
+
+        if event.get('ACTION') == 'remove' and (
+                event.get('DEVTYPE') == 'usb_device'):
+            self._set(name, None)
+        else:
+            self.update(name)
+
+    def process(self, timeout):
+        """Wait up to timeout seconds for events and apply them."""
+        for event in self.source.read(timeout):
+            self.handle(event)
+
+    def wait_for(self, predicate, timeout=None):
+        """
+        Wait until predicate(registry) returns something true and return it.
+
+        Returns the last (false) result of the predicate on timeout.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            result = predicate(self)
+            if result:
+                return result
+
+            wait = self.resync_interval
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return result
+                wait = min(wait, remaining)
+
+            self.process(wait)
+            if isinstance(self.source, PollingEventSource):
+                continue
+            if time.time() - self.last_resync >= self.resync_interval:
+                self.resync()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Advisory locks which stop two processes driving the same board at once.
+
+Each board has a lock file in LOCK_DIR named after the USB port it is plugged
+into (which stays the same while the FX2 re-enumerates), locked with flock().
+Anything changing a board takes an exclusive lock, read only queries take a
+shared one.
+
+Every user shares LOCK_DIR, so programs run by different users (or root)
+still keep out of each other's way.
+
+Locks are reentrant within a thread, so functions which take the lock can
+call each other.
+"""
+
+import fcntl
+import functools
+import os
+import threading
+import time
+
+
+# Where the lock files go, shared by all users.
+LOCK_DIR = '/run/lock/hdmi2usb'
+
+# Anyone can add lock files to LOCK_DIR, but only remove their own (sticky).
+LOCK_DIR_MODE = 0o1777
+
+# Anyone can lock a lock file, whoever created it.
+LOCK_FILE_MODE = 0o666
+
+# Seconds to wait for another process to release a board, None to wait
+# forever.
+LOCK_TIMEOUT = None
+
+# How often to try again while waiting for a lock.
+POLL_INTERVAL = 0.1
+
+
+class LockTimeout(TimeoutError):
+    pass
+
+
+class LockDirError(OSError):
+    pass
+
+
+class _Lock(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.fd = None
+        self.depth = 0
+        self.shared = True
+
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def lock_dir():
+    """LOCK_DIR, created if it doesn't exist yet."""
+    try:
+        os.mkdir(LOCK_DIR)
+        # Not left to the umask, as other users need to add to it.
+        os.chmod(LOCK_DIR, LOCK_DIR_MODE)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        raise LockDirError(
+            "Unable to create {} for locking boards: {}".format(
+                LOCK_DIR, e))
+    if not os.access(LOCK_DIR, os.W_OK | os.X_OK):
+        raise LockDirError(
+            "Unable to use {} for locking boards, it needs to be writable by "
+            "everyone (mode {:o})".format(LOCK_DIR, LOCK_DIR_MODE))
+    return LOCK_DIR
+
+
+def lock_path(port):
+    return os.path.join(lock_dir(), '{}.lock'.format(port))
+
+
+def _open(path):
+    """Open the lock file, creating it so everyone can lock it."""
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, LOCK_FILE_MODE)
+    except FileExistsError:
+        # Another user's file in a sticky directory can't be opened with
+        # O_CREAT (fs.protected_regular), flock() works read only.
+        return os.open(path, os.O_RDONLY)
+    try:
+        os.fchmod(fd, LOCK_FILE_MODE)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _flock(fd, operation, path, deadline):
+    """flock() the file, returning if we had to wait for it."""
+    waited = False
+    while True:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return waited
+        except BlockingIOError:
+            waited = True
+            if deadline is not None and time.time() > deadline:
+                raise LockTimeout(
+                    "Timed out waiting for {} to be unlocked".format(path))
+            time.sleep(POLL_INTERVAL)
+
+
+class BoardLock(object):
+    """
+    Lock the board at the given USB port.
+
+        with BoardLock(board.dev.port):
+            ...
+    """
+
+    def __init__(self, port, shared=False, timeout=None):
+        self.port = port
+        self.shared = shared
+        self.timeout = timeout
+        # Whether another process had the board locked when we wanted it.
+        self.waited = False
+
+    def __enter__(self):
+        timeout = self.timeout
+        if timeout is None:
+            timeout = LOCK_TIMEOUT
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        path = lock_path(self.port)
+        with _locks_lock:
+            lock = _locks.setdefault(path, _Lock(path))
+
+        # Other threads in this process wait here.
+        if not lock.thread_lock.acquire(
+                timeout=-1 if timeout is None else timeout):
+            raise LockTimeout(
+                "Timed out waiting for {} to be unlocked".format(path))
+        try:
+            if lock.depth == 0:
+                lock.fd = _open(path)
+                mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+                self.waited = _flock(lock.fd, mode, path, deadline)
+                lock.shared = self.shared
+            elif lock.shared and not self.shared:
+                # Upgrading a shared lock we already hold.
+                self.waited = _flock(lock.fd, fcntl.LOCK_EX, path, deadline)
+                lock.shared = False
+        except BaseException:
+            if lock.depth == 0 and lock.fd is not None:
+                os.close(lock.fd)
+                lock.fd = None
+            lock.thread_lock.release()
+            raise
+        lock.depth += 1
+        self.lock = lock
+        return self
+
+    def __exit__(self, *args):
+        lock = self.lock
+        lock.depth -= 1
+        if lock.depth == 0:
+            # Closing the file releases the flock.
+            os.close(lock.fd)
+            lock.fd = None
+        lock.thread_lock.release()
+
+
+def locked(func):
+    """Decorator which holds the lock on the board (the first argument)."""
+    @functools.wraps(func)
+    def wrapper(board, *args, **kwargs):
+        with BoardLock(board.dev.port):
+            return func(board, *args, **kwargs)
+    return wrapper
@@ -15,8 +15,6 @@ import subprocess
 
 from .base import *
 
-# Try and find unbind-helper
-
 
 def find_unbind_helper():
     callpaths = [
@@ -38,7 +36,19 @@ def find_unbind_helper():
     return None
 
 
-unbind_helper = find_unbind_helper()
+_unbind_helper = False
+
+
+def unbind_helper():
+    """
+    Path to the unbind-helper, or None.
+
+    Looking for it runs it, so it is only found the first time it is needed.
+    """
+    global _unbind_helper
+    if _unbind_helper is False:
+        _unbind_helper = find_unbind_helper()
+    return _unbind_helper
 
 
 SYS_ROOT = '/sys/bus/usb/devices'
@@ -154,10 +164,11 @@ class LsusbDevice(DeviceBase):
                 try:
                     open(unbind_path, "w").write(interface)
                 except PermissionError:
-                    if not unbind_helper:
+                    helper = unbind_helper()
+                    if not helper:
                         raise
                     subprocess.check_call("%s '%s' '%s'" % (
-                        unbind_helper, unbind_path, interface), shell=True)
+                        helper, unbind_path, interface), shell=True)
 
     def tty(self):
         ttys = []
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Long running OpenOCD instance driven over its TCL RPC port.
+
+Starting OpenOCD sets up the adapter, scans the JTAG chain and (for flashing)
+loads the BSCAN SPI proxy bitstream. Keeping one OpenOCD running and sending
+it commands means all that only happens once for several operations.
+
+The TCL RPC protocol is simple, each command is sent as text terminated with
+a 0x1a byte and the result comes back terminated the same way.
+"""
+
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import deque
+from collections import namedtuple
+
+
+TCL_TERMINATOR = b'\x1a'
+
+
+# Echoed into the output after each step of a script finishes.
+STEP_MARKER = "hdmi2usb step done"
+
+# What OpenOCD prints, checked in order with the first match winning.
+OUTPUT_PATTERNS = [(kind, re.compile(regex)) for kind, regex in [
+    # DNA Failed to read correctly if this error is seen.
+    ('retry', r"DNA = [01]+ \(0x18181818.*\)"),
+
+    # JTAG Errors
+    ('retry', r"Info : TAP xc6s.tap does not have IDCODE"),
+    ('retry', r"Warn : Bypassing JTAG setup events due to errors"),
+    ('retry', r"Error: Trying to use configured scan chain anyway..."),
+
+    # FIXME: Put fatal errors here.
+
+    ('step', STEP_MARKER + r" (?P<value>\d+)"),
+    ('dna', r"DNA = [01]+ \((?P<value>0x[0-9a-fA-F]+)\)"),
+    ('flash', r"Found flash device '(?P<value>[^']*)'"),
+    # jtagspi logs each sector it erases.
+    ('progress', r"sector (?P<value>\d+) took \d+ ms"),
+    ('speed', r"wrote \d+ bytes from file .* \((?P<value>[\d.]+) KiB/s\)"),
+    ('warning', r"^Warn : (?P<value>.*)"),
+    ('error', r"^Error: (?P<value>.*)"),
+]]
+
+# Lines of raw output kept for error reports.
+OUTPUT_LINES = 200
+
+
+Event = namedtuple('Event', ['kind', 'value', 'line'])
+
+
+class OutputParser(object):
+    """
+    Turns OpenOCD output into Events one line at a time.
+
+    Only the last OUTPUT_LINES lines of raw output are kept.
+    """
+
+    def __init__(self, lines=OUTPUT_LINES):
+        self.events = []
+        self.retry = []
+        self.fatal = []
+        self.lines = deque(maxlen=lines)
+
+    def feed(self, line):
+        """Parse one line of output, returning the Event for it (or None)."""
+        self.lines.append(line)
+        for kind, pattern in OUTPUT_PATTERNS:
+            found = pattern.search(line)
+            if not found:
+                continue
+            value = found.groupdict().get('value', found.group(0))
+            event = Event(kind, value, line.rstrip('\n'))
+            if kind == 'retry':
+                self.retry.append(found.group(0))
+            elif kind == 'fatal':
+                self.fatal.append(found.group(0))
+            self.events.append(event)
+            return event
+        return None
+
+    def output(self):
+        return "".join(self.lines)
+
+    def first(self, kind):
+        """Value of the first event of the given kind, or None."""
+        for event in self.events:
+            if event.kind == kind:
+                return event.value
+        return None
+
+
+def free_port(host='127.0.0.1'):
+    """Find a TCP port nothing is listening on."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+class OpenOCDSessionError(Exception):
+
+    def __init__(self, cmd, output, log=None):
+        self.cmd = cmd
+        self.output = output
+        self.log = log
+        msg = "OpenOCD command {!r} failed: {}".format(cmd, output)
+        if log:
+            msg += "\nOpenOCD output:\n-----\n{}\n-----".format(log)
+        Exception.__init__(self, msg)
+
+
+class OpenOCDSession(object):
+    """
+    OpenOCD running in the background with a TCL server on a free port.
+
+    Its telnet and gdb servers also get free ports (in .ports), so several
+    sessions can run at once and be attached to for debugging.
+
+        with OpenOCDSession("board/numato_opsis.cfg") as session:
+            session.once("init")
+            print(session.command("xc6s_print_dna xc6s.tap"))
+    """
+
+    def __init__(self, config=None, args=(), host='127.0.0.1', port=None,
+                 timeout=10, verbose=False):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.verbose = verbose
+
+        self.cmdline = None
+        self.ports = {}
+        if config is not None:
+            if self.port is None:
+                self.port = free_port(host)
+            self.ports = {
+                'tcl': self.port,
+                'telnet': free_port(host),
+                'gdb': free_port(host),
+            }
+            self.cmdline = ["openocd", "-f", config] + list(args)
+            self.cmdline += ["-c", "; ".join(
+                "{}_port {}".format(name, port)
+                for name, port in sorted(self.ports.items()))]
+
+        self.process = None
+        self.log = None
+        self.sock = None
+        self.buffer = b''
+        self.done = set()
+
+    @classmethod
+    def connect(cls, host, port, timeout=10, verbose=False):
+        """Session with an OpenOCD (or fake) which is already running."""
+        session = cls(host=host, port=port, timeout=timeout, verbose=verbose)
+        return session.start()
+
+    def start(self):
+        if self.cmdline is not None:
+            if self.verbose:
+                sys.stderr.write("Running %r\n" % self.cmdline)
+            self.log = tempfile.TemporaryFile()
+            self.process = subprocess.Popen(
+                self.cmdline, stdout=self.log, stderr=subprocess.STDOUT)
+
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                self.sock = socket.create_connection(
+                    (self.host, self.port), timeout=self.timeout)
+                break
+            except OSError as e:
+                exited = (
+                    self.process is not None
+                    and self.process.poll() is not None)
+                if exited:
+                    raise OpenOCDSessionError(
+                        "start", "exited with {}".format(
+                            self.process.returncode), self.output())
+                if time.time() > deadline:
+                    self.close()
+                    raise OpenOCDSessionError(
+                        "start", "unable to connect: {}".format(e),
+                        self.output())
+                time.sleep(0.05)
+        # The timeout is only for connecting, commands like jtagspi_program
+        # can take minutes.
+        self.sock.settimeout(None)
+        return self
+
+    def output(self):
+        """Everything OpenOCD has printed so far."""
+        if self.log is None:
+            return None
+        self.log.seek(0)
+        return self.log.read().decode('utf-8', 'replace')
+
+    def raw(self, text):
+        """Send text to the TCL server and return the reply."""
+        try:
+            self.sock.sendall(text.encode('utf-8') + TCL_TERMINATOR)
+            while TCL_TERMINATOR not in self.buffer:
+                data = self.sock.recv(4096)
+                if not data:
+                    break
+                self.buffer += data
+        except OSError as e:
+            raise OpenOCDSessionError(text, str(e), self.output())
+        if TCL_TERMINATOR not in self.buffer:
+            raise OpenOCDSessionError(
+                text, "connection closed", self.output())
+        reply, self.buffer = self.buffer.split(TCL_TERMINATOR, 1)
+        return reply.decode('utf-8', 'replace')
+
+    def command(self, cmd):
+        """
+        Run an OpenOCD command and return what it printed.
+
+        Raises OpenOCDSessionError if the command fails.
+        """
+        if self.verbose > 1:
+            sys.stderr.write("OpenOCD> %s\n" % cmd)
+        reply = self.raw(
+            "set _rc [catch {capture {%s}} _out]; set _r \"$_rc $_out\"" % cmd)
+        rc, _, output = reply.partition(' ')
+        if rc != '0':
+            raise OpenOCDSessionError(cmd, output, self.output())
+        if self.verbose > 1:
+            sys.stderr.write(output)
+        return output
+
+    def once(self, cmd):
+        """Run a setup command, unless it has already run in this session."""
+        if cmd in self.done:
+            return None
+        output = self.command(cmd)
+        self.done.add(cmd)
+        return output
+
+    def forget(self, prefix):
+        """Make setup commands starting with prefix run again next time."""
+        self.done = set(c for c in self.done if not c.startswith(prefix))
+
+    def close(self):
+        if self.sock is not None:
+            if self.process is not None:
+                try:
+                    self.raw("shutdown")
+                except (OSError, OpenOCDSessionError):
+                    # OpenOCD can exit before replying.
+                    pass
+            self.sock.close()
+            self.sock = None
+
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def __enter__(self):
+        if self.sock is None:
+            self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Work out the cheapest way to get a board from the state it is in to the state
+we want it in.
+
+Each transition between states is an edge with a cost (how many seconds it
+takes) and may be known to be flaky. How long transitions actually take and
+how often they fail is recorded between runs, so the costs (and which edges
+are flaky) follow what happens on real hardware.
+"""
+
+import heapq
+
+from collections import namedtuple
+
+from . import cache
+
+
+STATES = {
+    'atlys': [
+        'unconfigured', 'jtag', 'operational', 'dfu-boot',
+        'test-jtag', 'test-serial', 'test-audio', 'test-uvc', 'test-???',
+    ],
+    'opsis': [
+        'unconfigured', 'jtag', 'serial', 'eeprom', 'operational', 'dfu-boot',
+        'test-serial', 'test-audio', 'test-uvc',
+    ],
+}
+
+# States which can be reached by loading firmware onto the FX2.
+FX2_TARGETS = {
+    'atlys': ['jtag', 'dfu-boot'],
+    'opsis': ['jtag', 'serial', 'eeprom', 'dfu-boot'],
+}
+
+# Seconds a transition is assumed to take before it has been measured.
+DEFAULT_COST = 2.0
+
+# Transitions which are known to sometimes leave the board in a bad state.
+FLAKY_TRANSITIONS = {
+    # The FX2 on the Opsis doesn't reliably come up in jtag mode unless it
+    # goes through serial mode first.
+    ('opsis', 'unconfigured', 'jtag'),
+    ('opsis', 'operational', 'jtag'),
+    ('opsis', 'eeprom', 'jtag'),
+}
+
+# A measured transition is treated as flaky once it has been tried at least
+# FLAKY_MIN_ATTEMPTS times and failed more often than FLAKY_FAILURE_RATE.
+FLAKY_MIN_ATTEMPTS = 3
+FLAKY_FAILURE_RATE = 0.2
+
+# Weight given to the newest measurement of how long a transition takes.
+COST_SMOOTHING = 0.3
+
+
+Transition = namedtuple('Transition', ['start', 'end', 'cost', 'flaky'])
+
+
+class NoPathError(ValueError):
+    pass
+
+
+class Planner(object):
+
+    def __init__(self, board_type, stats_path=None):
+        assert board_type in STATES, board_type
+        self.board_type = board_type
+        if stats_path is None:
+            stats_path = cache.cache_path('transitions.json')
+        self.stats_path = stats_path
+        self.stats = cache.load_json(stats_path, {})
+
+    def _key(self, start, end):
+        return "{} {}->{}".format(self.board_type, start, end)
+
+    def transition(self, start, end):
+        stats = self.stats.get(self._key(start, end), {})
+        cost = stats.get('cost', DEFAULT_COST)
+
+        flaky = (self.board_type, start, end) in FLAKY_TRANSITIONS
+        attempts = stats.get('attempts', 0)
+        if attempts >= FLAKY_MIN_ATTEMPTS:
+            failure_rate = stats.get('failures', 0) / attempts
+            flaky = failure_rate > FLAKY_FAILURE_RATE
+        return Transition(start, end, cost, flaky)
+
+    def edges(self, start):
+        for end in FX2_TARGETS[self.board_type]:
+            if end != start:
+                yield self.transition(start, end)
+
+    def _search(self, start, end, allow_flaky):
+        queue = [(0, 0, start, [])]
+        done = set()
+        counter = 1
+        while queue:
+            cost, _, state, path = heapq.heappop(queue)
+            if state == end:
+                return path
+            if state in done:
+                continue
+            done.add(state)
+
+            for edge in self.edges(state):
+                if edge.flaky and not allow_flaky:
+                    continue
+                # Only go into the DFU bootloader when that is the goal.
+                if edge.end == 'dfu-boot' and end != 'dfu-boot':
+                    continue
+                if edge.end in done:
+                    continue
+                heapq.heappush(queue, (
+                    cost + edge.cost, counter, edge.end, path + [edge]))
+                counter += 1
+        return None
+
+    def plan(self, start, end):
+        """
+        Cheapest list of transitions from start to end.
+
+        Flaky transitions are only used if there is no other way.
+        """
+        assert start in STATES[self.board_type], start
+        path = self._search(start, end, allow_flaky=False)
+        if path is None:
+            path = self._search(start, end, allow_flaky=True)
+        if path is None:
+            raise NoPathError("No way to get {} from {} to {}".format(
+                self.board_type, start, end))
+        return path
+
+    def record(self, transition, duration, ok):
+        """Record how a transition went, updating its cost and flakiness."""
+        key = self._key(transition.start, transition.end)
+        with cache.updating_json(self.stats_path, {}) as all_stats:
+            self.stats = all_stats
+            stats = all_stats.setdefault(
+                key, {'attempts': 0, 'failures': 0})
+            stats['attempts'] += 1
+            if ok:
+                cost = stats.get('cost', duration)
+                stats['cost'] = (
+                    COST_SMOOTHING * duration + (1 - COST_SMOOTHING) * cost)
+            else:
+                stats['failures'] += 1
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Snapshots of the SPI flash on boards, kept in a content addressed store.
+
+The flash is split into the regions from BOARD_FLASH_MAP and each region into
+chunks (never crossing an erase sector). Every chunk is stored once under its
+sha256, so the same gateware on many boards (or the empty end of the flash)
+only takes up space once. A snapshot is a manifest listing the chunks.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from . import cache
+from . import flash
+
+
+class SnapshotStore(object):
+
+    def __init__(self, root=None):
+        if root is None:
+            root = os.path.join(cache.cache_dir(), 'snapshots')
+        self.root = root
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.root, 'chunks', digest[:2], digest)
+
+    def _manifest_dir(self, key):
+        return os.path.join(
+            self.root, 'manifests', re.sub(r'[^A-Za-z0-9.-]+', '_', key))
+
+    def add_chunk(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._chunk_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(path), suffix='.tmp',
+                    delete=False) as f:
+                f.write(data)
+            os.replace(f.name, path)
+        return digest
+
+    def read_chunk(self, digest):
+        with open(self._chunk_path(digest), 'rb') as f:
+            data = f.read()
+        assert hashlib.sha256(data).hexdigest() == digest, (
+            "Chunk {} is corrupt".format(digest))
+        return data
+
+    def add(self, key, board_type, regions):
+        """
+        Store a snapshot of the board identified by key.
+
+        regions is a list of (name, start, filename) with the contents of
+        each region. Returns the path of the manifest.
+        """
+        manifest = {
+            'board': key,
+            'type': board_type,
+            'created': time.time(),
+            'regions': [],
+        }
+        for name, start, filename in regions:
+            data = flash.read_mapped(filename)
+            chunks = []
+            for offset, size in flash.chunks(start, len(data)):
+                digest = self.add_chunk(
+                    data[offset - start:offset - start + size])
+                chunks.append([offset, size, digest])
+            manifest['regions'].append({
+                'name': name,
+                'start': start,
+                'length': len(data),
+                'chunks': chunks,
+            })
+
+        path = os.path.join(
+            self._manifest_dir(key),
+            time.strftime('%Y%m%d-%H%M%S.json', time.gmtime(
+                manifest['created'])))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cache.save_json(path, manifest)
+        return path
+
+    def manifests(self, key):
+        """Paths of the snapshots of the board, oldest first."""
+        directory = self._manifest_dir(key)
+        if not os.path.isdir(directory):
+            return []
+        return [
+            os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.endswith('.json')]
+
+    def find(self, key, name='latest'):
+        """Path of a snapshot, by path, name or 'latest'."""
+        if os.path.exists(name):
+            return name
+        manifests = self.manifests(key)
+        assert manifests, "No snapshots of {}".format(key)
+        if name == 'latest':
+            return manifests[-1]
+        for path in manifests:
+            if os.path.basename(path) in (name, name + '.json'):
+                return path
+        assert False, "No snapshot {} of {}".format(name, key)
+
+    def load(self, path):
+        manifest = cache.load_json(path)
+        assert manifest is not None, "Unable to read {}".format(path)
+        return manifest
+
+    def write_region(self, region, filename):
+        """Write the contents of a region in a snapshot out to a file."""
+        position = region['start']
+        with open(filename, 'wb') as f:
+            for offset, size, digest in region['chunks']:
+                assert offset == position, (offset, position)
+                f.write(self.read_chunk(digest))
+                position += size
+        return filename
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Functions needed by hdmi2usb-mode-switch implemented by reading the Linux
+sysfs directly.
+
+Unlike the lsusb backend this never starts a child process, everything the
+tool needs is read in a single pass over /sys/bus/usb/devices into a
+SysfsSnapshot and later lookups are served from memory.
+
+This will only run on Linux.
+"""
+
+import itertools
+import logging
+import os
+
+from collections import namedtuple
+from types import MappingProxyType
+
+from .base import *
+from .lsusb import LsusbDevice, SYS_ROOT
+
+
+# Incremented by the kernel for every uevent, including devices being bound
+# to and unbound from drivers.
+UEVENT_SEQNUM = '/sys/kernel/uevent_seqnum'
+
+# Device nodes for every USB device, /dev/bus/usb/<bus>/<device>.
+USBFS_ROOT = '/dev/bus/usb'
+
+# Attributes read for every device directory.
+DEVICE_ATTRS = (
+    'busnum', 'devnum', 'idVendor', 'idProduct', 'bcdDevice', 'serial')
+
+
+def _read_attrs(entries, names):
+    attrs = {}
+    for name in names:
+        entry = entries.get(name)
+        if entry is None:
+            continue
+        with open(entry.path, 'r') as f:
+            attrs[name] = f.read().strip()
+    return attrs
+
+
+def _scan_links(entries):
+    driver = None
+    if 'driver' in entries:
+        driver = os.readlink(entries['driver'].path)
+
+    tty = ()
+    if 'tty' in entries:
+        tty = tuple(sorted(os.listdir(entries['tty'].path)))
+    return driver, tty
+
+
+_SysfsSnapshotBase = namedtuple(
+    'SysfsSnapshot',
+    ['generation', 'root', 'devices', 'interfaces', 'drivers', 'ttys'])
+
+_generations = itertools.count(1)
+
+
+class SysfsSnapshot(_SysfsSnapshotBase):
+    """
+    Immutable view of the USB part of sysfs at one point in time.
+
+     * devices    - device directory name -> attribute mapping
+     * interfaces - device directory name -> interface sysfs paths
+     * drivers    - sysfs path -> driver link target
+     * ttys       - sysfs path -> tty names found under it
+
+    Every snapshot gets a new, increasing generation number.
+    """
+
+    @classmethod
+    def take(cls, root=None, names=None):
+        """
+        Read sysfs into a new snapshot.
+
+        If names is given, only those device directories (and their
+        interfaces) are read rather than the whole bus.
+        """
+        # 1-1.3.1  --> (Device)    bus-port.port.port
+        # 1-0:1.0  --> (Interface) bus-port.port.port:config.interface
+        # usb1     --> bus<number>
+        if root is None:
+            root = SYS_ROOT
+
+        expand = names is not None
+        if names is None:
+            names = [e.name for e in os.scandir(root)]
+        else:
+            names = list(names)
+
+        devices = {}
+        interfaces = {}
+        drivers = {}
+        ttys = {}
+        while names:
+            name = names.pop()
+            dirpath = os.path.join(root, name)
+            try:
+                entries = {e.name: e for e in os.scandir(dirpath)}
+                driver, tty = _scan_links(entries)
+            except FileNotFoundError:
+                # Device went away while we were looking at it.
+                continue
+
+            if driver is not None:
+                drivers[dirpath] = driver
+            if tty:
+                ttys[dirpath] = tty
+
+            if ":" in name:
+                device = name.split(':')[0]
+                if device.endswith('-0'):
+                    device = "usb%s" % (device[:-2])
+                interfaces.setdefault(device, []).append(dirpath)
+                continue
+
+            if expand:
+                # Interfaces are also child directories of their device.
+                names.extend(n for n in entries if n.startswith(name + ':'))
+
+            attrs = _read_attrs(entries, DEVICE_ATTRS)
+            if 'busnum' not in attrs or 'devnum' not in attrs:
+                logging.info("Skipping %s (no busnum/devnum)", dirpath)
+                continue
+            devices[name] = MappingProxyType(attrs)
+
+        return cls(
+            generation=next(_generations),
+            root=root,
+            devices=MappingProxyType(devices),
+            interfaces=MappingProxyType(
+                {k: tuple(sorted(v)) for k, v in interfaces.items()}),
+            drivers=MappingProxyType(drivers),
+            ttys=MappingProxyType(ttys),
+        )
+
+    def subset(self, names):
+        """Snapshot of just the given devices (and their interfaces)."""
+        names = set(names)
+        paths = set()
+        for name in names:
+            paths.update(self.syspaths(name))
+        return self._replace(
+            generation=next(_generations),
+            devices=MappingProxyType(
+                {k: v for k, v in self.devices.items() if k in names}),
+            interfaces=MappingProxyType(
+                {k: v for k, v in self.interfaces.items() if k in names}),
+            drivers=MappingProxyType(
+                {k: v for k, v in self.drivers.items() if k in paths}),
+            ttys=MappingProxyType(
+                {k: v for k, v in self.ttys.items() if k in paths}),
+        )
+
+    def to_json(self):
+        return {
+            'root': self.root,
+            'devices': {k: dict(v) for k, v in self.devices.items()},
+            'interfaces': {k: list(v) for k, v in self.interfaces.items()},
+            'drivers': dict(self.drivers),
+            'ttys': {k: list(v) for k, v in self.ttys.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            generation=next(_generations),
+            root=data['root'],
+            devices=MappingProxyType({
+                k: MappingProxyType(v) for k, v in data['devices'].items()}),
+            interfaces=MappingProxyType({
+                k: tuple(v) for k, v in data['interfaces'].items()}),
+            drivers=MappingProxyType(data['drivers']),
+            ttys=MappingProxyType({
+                k: tuple(v) for k, v in data['ttys'].items()}),
+        )
+
+    def syspaths(self, dirname):
+        """Sorted sysfs paths for a device and all its interfaces."""
+        return sorted(
+            [os.path.join(self.root, dirname)] + list(
+                self.interfaces.get(dirname, ())))
+
+
+class SysfsDevice(LsusbDevice):
+
+    def __new__(cls, *args, port, syspaths, snapshot, **kw):
+        d = DeviceBase.__new__(cls, *args, **kw)
+        # sysfs name of the port the device is plugged into, like '3-1.4'.
+        d.port = port
+        d.syspaths = syspaths
+        d.snapshot = snapshot
+        return d
+
+    def drivers(self):
+        drivers = [self.snapshot.drivers.get(p) for p in self.syspaths[1:]]
+        return tuple(set(d.split('/')[-1] for d in drivers if d))
+
+    def tty(self):
+        ttys = []
+        for path in self.syspaths:
+            names = self.snapshot.ttys.get(path, ())
+            assert len(names) <= 1, names
+            ttys.extend('/dev/' + name for name in names)
+        return ttys
+
+
+Device = SysfsDevice
+
+
+def bus_state():
+    """
+    Cheap fingerprint of the USB devices in the system, which changes when
+    devices come, go or change drivers.
+
+    Made of the uevent sequence number and the device nodes under
+    /dev/bus/usb (a new node is created each time a device enumerates), so
+    finding it only takes a few reads of directories rather than a walk of
+    sysfs.
+    """
+    try:
+        with open(UEVENT_SEQNUM, 'r') as f:
+            seqnum = f.read().strip()
+    except OSError:
+        seqnum = None
+
+    nodes = []
+    try:
+        for bus in os.scandir(USBFS_ROOT):
+            for node in os.scandir(bus.path):
+                nodes.append(
+                    [os.path.join(bus.name, node.name), node.inode()])
+    except FileNotFoundError:
+        pass
+    return [seqnum, sorted(nodes)]
+
+
+def _read_ids(root, name):
+    ids = []
+    for attr in ('idVendor', 'idProduct'):
+        with open(os.path.join(root, name, attr), 'r') as f:
+            ids.append(int(f.read().strip(), base=16))
+    return tuple(ids)
+
+
+def matching_ports(root=None, ids=None, ports=None):
+    """
+    Generate the sysfs names of the devices with (vid, pid) in ids.
+
+    Only idVendor and idProduct are read from each device. ports limits the
+    search to those device directories, None looks at all of them.
+    """
+    if root is None:
+        root = SYS_ROOT
+    if ports is None:
+        ports = (e.name for e in os.scandir(root) if ':' not in e.name)
+    for name in sorted(ports):
+        if ids is not None:
+            try:
+                if _read_ids(root, name) not in ids:
+                    continue
+            except FileNotFoundError:
+                # Not there or not a device (like a usb1 being removed).
+                continue
+        yield name
+
+
+def find_usb_devices(snapshot=None):
+    if snapshot is None:
+        snapshot = SysfsSnapshot.take()
+
+    devobjs = []
+    for dirname, attrs in sorted(snapshot.devices.items()):
+        devobjs.append(SysfsDevice(
+            vid=int(attrs['idVendor'], base=16),
+            pid=int(attrs['idProduct'], base=16),
+            did=attrs.get('bcdDevice'),
+            serialno=attrs.get('serial'),
+            path=Path(bus=int(attrs['busnum']), address=int(attrs['devnum'])),
+            port=dirname,
+            syspaths=snapshot.syspaths(dirname),
+            snapshot=snapshot,
+        ))
+
+    return devobjs
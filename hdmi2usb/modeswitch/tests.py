@@ -2,11 +2,54 @@
 # vim: set ts=4 sw=4 et sts=4 ai:
 
 """
-Tests which show the libusb and lsusb implementations work the same way.
+Tests which show the libusb, lsusb and sysfs implementations work the same way.
 """
 
+import binascii
+import contextlib
+import fcntl
+import io
+import os
+import re
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import usb.core
+import usb.util
+
+from . import boards
+from . import cache
+from . import dfu
+from . import cli
+from . import files
+from . import flash
+from . import fx2
+from . import hotplug
+from . import lock
+from . import openocd
+from . import planner
+from . import snapshot
 from . import libusb
 from . import lsusb
+from . import sysfs
+
+
+@contextlib.contextmanager
+def patched(obj, **attrs):
+    """Replace attributes of obj (like a module) while in the block."""
+    saved = dict((name, getattr(obj, name)) for name in attrs)
+    for name, value in attrs.items():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(obj, name, value)
 
 
 def test_libusb_and_lsusb_equal():
@@ -42,4 +85,1290 @@ def test_libusb_and_lsusb_equal():
                 libobj_inuse, lsobj_inuse)
 
 
+def test_sysfs_and_lsusb_equal():
+    sysfs_devices = sysfs.find_usb_devices()
+    lsusb_devices = lsusb.find_usb_devices()
+    assert len(sysfs_devices) == len(lsusb_devices), "len: %r == %r" % (
+        len(sysfs_devices), len(lsusb_devices))
+    for sysobj, lsobj in zip(sorted(sysfs_devices), sorted(lsusb_devices)):
+        print("%s -- sys: %-60s ls: %-60s" % (sysobj.path, sysobj, lsobj))
+        assert sysobj == lsobj, "%r == %r" % (sysobj, lsobj)
+        assert sysobj.syspaths == lsobj.syspaths, "syspaths: %r == %r" % (
+            sysobj.syspaths, lsobj.syspaths)
+        assert sysobj.drivers() == lsobj.drivers(), "drivers: %r == %r" % (
+            sysobj.drivers(), lsobj.drivers())
+        assert sysobj.tty() == lsobj.tty(), "tty: %r == %r" % (
+            sysobj.tty(), lsobj.tty())
+
+
+def test_hotplug_registry_events():
+    source = hotplug.QueueEventSource()
+    events = []
+    with hotplug.HotplugRegistry(source=source) as registry:
+        registry.on_add(lambda name, dev, board: events.append(('add', name)))
+        registry.on_remove(
+            lambda name, dev, board: events.append(('remove', name)))
+
+        devices = sysfs.find_usb_devices()
+        assert sorted(registry.devices) == sorted(d.port for d in devices)
+
+        # A remove event drops the device without rescanning the bus.
+        name = devices[-1].port
+        source.push(ACTION='remove', DEVPATH='/devices/' + name,
+                    SUBSYSTEM='usb', DEVTYPE='usb_device')
+        registry.process(0)
+        assert name not in registry.devices, registry.devices
+        assert events == [('remove', name)], events
+
+        # An add event reads just that device back in again.
+        source.push(ACTION='add', DEVPATH='/devices/' + name,
+                    SUBSYSTEM='usb', DEVTYPE='usb_device')
+        found = registry.wait_for(lambda r: r.devices.get(name), timeout=1)
+        assert found == devices[-1], (found, devices[-1])
+        assert events == [('remove', name), ('add', name)], events
+
+
+def test_hotplug_registry_ports():
+    take = sysfs.SysfsSnapshot.take
+    taken = []
+
+    def fake_take(cls, root=None, names=None):
+        taken.append(names)
+        return take(root=tmpdir, names=names)
+
+    source = hotplug.QueueEventSource()
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            patched(sysfs.SysfsSnapshot, take=classmethod(fake_take)):
+        registry = hotplug.HotplugRegistry(
+            source=source, resync_interval=0.1, ports=['3-1.4'])
+        with registry:
+            # Only the port asked for is read, never the whole bus.
+            assert taken == [['3-1.4']], taken
+
+            # Events for other ports are ignored.
+            source.push(ACTION='add', DEVPATH='/devices/3-1.2',
+                        SUBSYSTEM='usb', DEVTYPE='usb_device')
+            registry.process(0)
+            assert taken == [['3-1.4']], taken
+
+            source.push(ACTION='add', DEVPATH='/devices/3-1.4',
+                        SUBSYSTEM='usb', DEVTYPE='usb_device')
+            registry.process(0)
+            assert taken == [['3-1.4'], ['3-1.4']], taken
+
+            # The occasional rescan only rereads the port too.
+            registry.wait_for(lambda r: r.devices.get('3-1.4'), timeout=0.25)
+            assert len(taken) > 2, taken
+            assert all(names == ['3-1.4'] for names in taken), taken
+
+
+class MockFX2Device(object):
+    """Pretends to be a Cypress FX2 which is having firmware loaded."""
+
+    def __init__(self):
+        self.ram = bytearray(0x10000)
+        self.transfers = []
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue, wIndex,
+                      data_or_wLength, timeout=None):
+        assert bRequest == fx2.FX2_FIRMWARE_LOAD, bRequest
+        if bmRequestType == fx2.CTRL_IN:
+            return bytearray(self.ram[wValue:wValue + data_or_wLength])
+
+        assert bmRequestType == fx2.CTRL_OUT, bmRequestType
+        data = bytes(data_or_wLength)
+        assert len(data) <= fx2.FX2_MAX_TRANSFER, len(data)
+        if wValue != fx2.FX2_CPUCS:
+            assert self.ram[fx2.FX2_CPUCS] & 1, "RAM written while running"
+        self.transfers.append((wValue, len(data)))
+        self.ram[wValue:wValue + len(data)] = data
+        if wValue == fx2.FX2_CPUCS and data == b'\x00':
+            # New firmware starts and the device re-enumerates.
+            raise usb.core.USBError("No such device")
+        return len(data)
+
+
+def test_fx2_load_ram():
+    filename = os.path.join(
+        os.path.dirname(__file__), '..', 'firmware', 'boot-dfu.ihex')
+    hexfile = files.IntelHexFile(filename)
+
+    dev = MockFX2Device()
+    fx2.load_file(dev, filename, verify=True)
+
+    for address, data in hexfile.segments:
+        assert dev.ram[address:address + len(data)] == data, hex(address)
+    assert dev.ram[fx2.FX2_CPUCS] == 0
+    assert dev.transfers[0] == (fx2.FX2_CPUCS, 1), dev.transfers
+    assert dev.transfers[-1] == (fx2.FX2_CPUCS, 1), dev.transfers
+    # One transfer per 4k of each segment, plus holding / releasing reset.
+    assert len(dev.transfers) == 2 + sum(
+        (len(d) + fx2.FX2_MAX_TRANSFER - 1) // fx2.FX2_MAX_TRANSFER
+        for _, d in hexfile.segments), dev.transfers
+
+    try:
+        fx2.load_ram(dev, [(0x4000, b'\x00')])
+        assert False, "Load outside RAM should fail"
+    except fx2.FX2LoadError as e:
+        assert e.as_dict()['stage'] == 'range', e.as_dict()
+
+
+class MockDFUInterface(object):
+
+    def __init__(self, number, cls, subclass=0, extra=b''):
+        self.bInterfaceNumber = number
+        self.bInterfaceClass = cls
+        self.bInterfaceSubClass = subclass
+        self.bAlternateSetting = 0
+        self.extra_descriptors = list(extra)
+
+
+class MockDFUDevice(object):
+    """
+    Pretends to be a DFU 1.1 device which is having firmware downloaded.
+
+    Each block is busy for poll_timeout ms. With fail_at, the block which
+    would be written at that offset fails with errWRITE.
+    """
+    STATUS_ERR_WRITE = 3
+
+    def __init__(self, transfer_size=64, poll_timeout=5, fail_at=None):
+        self.idVendor = 0x2a19
+        self.idProduct = 0x5441
+        self.transfer_size = transfer_size
+        self.poll_timeout = poll_timeout
+        self.fail_at = fail_at
+        self.status = dfu.STATUS_OK
+        self.state = dfu.STATE_DFU_IDLE
+        self.data = bytearray()
+        self.blocks = []
+        self.manifested = False
+        self.cleared = 0
+
+    def get_active_configuration(self):
+        functional = struct.pack(
+            '<BBBHHH', 9, dfu.DFU_FUNCTIONAL, 0x0b, 255, self.transfer_size,
+            0x0110)
+        return [
+            MockDFUInterface(0, 0xff),
+            # Another class specific descriptor in front of the DFU one.
+            MockDFUInterface(
+                1, dfu.DFU_CLASS, dfu.DFU_SUBCLASS,
+                b'\x03\x24\x00' + functional),
+        ]
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue, wIndex,
+                      data_or_wLength, timeout=None):
+        assert wIndex == 1, wIndex
+        if bRequest == dfu.DFU_GETSTATUS:
+            assert bmRequestType == dfu.CTRL_IN, bmRequestType
+            state = self.state
+            poll = 0
+            if state == dfu.STATE_DFU_DNLOAD_SYNC:
+                # Busy writing the block, done once the poll timeout is up.
+                state = dfu.STATE_DFU_DNBUSY
+                poll = self.poll_timeout
+                self.state = dfu.STATE_DFU_DNLOAD_IDLE
+            elif state == dfu.STATE_DFU_MANIFEST_SYNC:
+                state = dfu.STATE_DFU_MANIFEST
+                poll = self.poll_timeout
+                self.state = dfu.STATE_DFU_IDLE
+                self.manifested = True
+            return bytearray(struct.pack(
+                '<BHBB', self.status, poll & 0xffff, poll >> 16, state))
+
+        assert bmRequestType == dfu.CTRL_OUT, bmRequestType
+        if bRequest == dfu.DFU_CLRSTATUS:
+            self.status = dfu.STATUS_OK
+            self.state = dfu.STATE_DFU_IDLE
+            self.cleared += 1
+        elif bRequest == dfu.DFU_ABORT:
+            self.state = dfu.STATE_DFU_IDLE
+        elif bRequest == dfu.DFU_DNLOAD:
+            assert self.state in (
+                dfu.STATE_DFU_IDLE, dfu.STATE_DFU_DNLOAD_IDLE), self.state
+            assert wValue == len(self.blocks) & 0xffff, wValue
+            data = bytes(data_or_wLength or b'')
+            if not data:
+                self.state = dfu.STATE_DFU_MANIFEST_SYNC
+                return 0
+            assert len(data) <= self.transfer_size, len(data)
+            self.blocks.append(len(data))
+            if self.fail_at is not None and len(self.data) >= self.fail_at:
+                self.status = self.STATUS_ERR_WRITE
+                self.state = dfu.STATE_DFU_ERROR
+                return len(data)
+            self.data += data
+            self.state = dfu.STATE_DFU_DNLOAD_SYNC
+            return len(data)
+        else:
+            assert False, bRequest
+
+
+def write_dfu_file(filename, data, crc=None):
+    """Write data with a DFU suffix (for 2a19:5441) to filename."""
+    data += struct.pack('<HHHH3sB', 0xffff, 0x5441, 0x2a19, 0x0100, b'UFD', 16)
+    if crc is None:
+        crc = binascii.crc32(data) ^ 0xFFFFFFFF
+    with open(filename, 'wb') as f:
+        f.write(data + struct.pack('<I', crc))
+
+
+def test_dfu_download():
+    firmware = bytes(range(256)) * 2 + b'end'
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'firmware.dfu')
+        write_dfu_file(filename, firmware)
+        dfufile = dfu.DFUFile(filename)
+        assert dfufile.data == firmware
+        assert (dfufile.vid, dfufile.pid) == (0x2a19, 0x5441), str(dfufile)
+
+        bad = os.path.join(tmpdir, 'bad.dfu')
+        write_dfu_file(bad, firmware, crc=0x12345678)
+        try:
+            dfu.DFUFile(bad)
+            assert False, "Bad CRC should fail"
+        except TypeError as e:
+            assert 'CRC' in str(e), e
+
+        dev = MockDFUDevice(transfer_size=100, poll_timeout=5)
+        intf, transfer_size = dfu.find_interface(dev)
+        assert (intf.bInterfaceNumber, transfer_size) == (1, 100)
+
+        class FakeTime(object):
+            def __init__(self):
+                self.slept = []
+
+            def time(self):
+                return 0
+
+            def sleep(self, seconds):
+                self.slept.append(seconds)
+
+        fake_time = FakeTime()
+        progress = []
+        with patched(usb.util, claim_interface=lambda dev, intf: None,
+                     release_interface=lambda dev, intf: None), \
+                patched(dfu, time=fake_time):
+            dfu.download_file(
+                dev, filename, progress=lambda *args: progress.append(args))
+
+            assert dev.data == firmware
+            assert dev.blocks == [100] * 5 + [len(firmware) - 500]
+            assert dev.manifested
+            assert progress[-1] == (len(firmware), len(firmware)), progress
+            # bwPollTimeout is waited out after each block (and manifesting).
+            assert fake_time.slept == [0.005] * 7, fake_time.slept
+
+            dev = MockDFUDevice(transfer_size=100, fail_at=200)
+            try:
+                dfu.download(dev, firmware)
+                assert False, "Write error should fail"
+            except dfu.DFUError as e:
+                assert (e.status, e.offset) == (
+                    MockDFUDevice.STATUS_ERR_WRITE, 200), e
+                assert e.state == dfu.STATE_DFU_ERROR, e
+            assert dev.cleared == 1
+
+
+def test_planner_avoids_flaky_transitions():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stats = os.path.join(tmpdir, 'transitions.json')
+        p = planner.Planner('opsis', stats_path=stats)
+
+        # Going straight into jtag mode is flaky on the Opsis.
+        plan = p.plan('operational', 'jtag')
+        assert [t.end for t in plan] == ['serial', 'jtag'], plan
+
+        # Measured failures make a transition flaky too.
+        for i in range(planner.FLAKY_MIN_ATTEMPTS):
+            p.record(plan[0], 1.0, ok=False)
+        p = planner.Planner('opsis', stats_path=stats)
+        plan = p.plan('operational', 'jtag')
+        assert [t.end for t in plan] == ['eeprom', 'serial', 'jtag'], plan
+
+
+class FakeOpenOCDServer(threading.Thread):
+    """
+    Pretends to be the TCL RPC server of OpenOCD.
+
+    Commands are looked up in the responses dictionary, unknown commands
+    fail. Each reply is sent after waiting delay seconds.
+    """
+
+    def __init__(self, responses, delay=0):
+        threading.Thread.__init__(self, daemon=True)
+        self.responses = responses
+        self.delay = delay
+        self.received = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+    def reply(self, text):
+        m = re.match(r"set _rc \[catch {capture {(.*)}} _out\]", text)
+        if not m:
+            return ""
+        cmd = m.group(1)
+        self.received.append(cmd)
+        if cmd not in self.responses:
+            return "1 invalid command name \"{}\"".format(cmd)
+        return "0 " + self.responses[cmd]
+
+    def run(self):
+        conn, _ = self.listener.accept()
+        data = b''
+        while True:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+            while openocd.TCL_TERMINATOR in data:
+                text, data = data.split(openocd.TCL_TERMINATOR, 1)
+                reply = self.reply(text.decode('utf-8'))
+                time.sleep(self.delay)
+                conn.sendall(reply.encode('utf-8') + openocd.TCL_TERMINATOR)
+        conn.close()
+        self.listener.close()
+
+
+def test_openocd_session():
+    server = FakeOpenOCDServer({
+        'init': '',
+        'xc6s_print_dna xc6s.tap': 'DNA = 1010 (0x0a)\n',
+    })
+    server.start()
+
+    session = openocd.OpenOCDSession.connect('127.0.0.1', server.port)
+    with session:
+        assert session.once('init') == ''
+        assert session.once('init') is None
+        assert session.command('xc6s_print_dna xc6s.tap') == (
+            'DNA = 1010 (0x0a)\n')
+        try:
+            session.command('flash probe 0')
+            assert False, "Unknown command should fail"
+        except openocd.OpenOCDSessionError as e:
+            assert 'invalid command name' in e.output, e.output
+
+    server.join(1)
+    assert server.received == [
+        'init', 'xc6s_print_dna xc6s.tap', 'flash probe 0'], server.received
+
+    # The connect timeout doesn't apply to slow commands.
+    server = FakeOpenOCDServer({'jtagspi_program g.bin 0x0': ''}, delay=0.6)
+    server.start()
+    session = openocd.OpenOCDSession.connect(
+        '127.0.0.1', server.port, timeout=0.3)
+    with session:
+        assert session.command('jtagspi_program g.bin 0x0') == ''
+        session.sock.shutdown(socket.SHUT_RDWR)
+        try:
+            session.command('init')
+            assert False, "Closed connection should fail"
+        except openocd.OpenOCDSessionError:
+            pass
+    server.join(1)
+
+
+def test_openocd_merge_steps():
+    flash_setup = ["init", "xc6s_print_dna xc6s.tap", "jtagspi_init 0 p.bit"]
+    steps = [
+        boards.Step(flash_setup, ["jtagspi_program g.bin 0x0"]),
+        boards.Step(flash_setup, ["jtagspi_program b.bin 0x200000"]),
+        boards.Step(["init", "xc6s_print_dna xc6s.tap"], ["pld load 0 g.bit"]),
+        boards.Step(flash_setup, ["jtagspi_program f.bin 0x280000"]),
+    ]
+    assert boards._openocd_merge(steps) == [
+        "init",
+        "xc6s_print_dna xc6s.tap",
+        "jtagspi_init 0 p.bit",
+        "jtagspi_program g.bin 0x0",
+        "jtagspi_program b.bin 0x200000",
+        "pld load 0 g.bit",
+        # Loading gateware replaced the SPI flash proxy.
+        "jtagspi_init 0 p.bit",
+        "jtagspi_program f.bin 0x280000",
+    ], boards._openocd_merge(steps)
+
+    script = boards._openocd_merge(steps[2:], markers=True)
+    assert script[-1] == 'echo "{} 1"'.format(openocd.STEP_MARKER), script
+    parser = openocd.OutputParser()
+    event = parser.feed("{} 1\n".format(openocd.STEP_MARKER))
+    assert event.kind == 'step' and event.value == '1', event
+
+
+def test_openocd_retry():
+    board = boards.Board(dev=FakeDevice(), type='opsis', state='jtag')
+    done = []
+    steps = [
+        boards.Step(["init"], ["step {}".format(i)],
+                    lambda i=i: done.append(i))
+        for i in range(3)]
+
+    def retry_error(finished, errors):
+        # finished steps echoed their markers before OpenOCD failed.
+        error = boards.OpenOCDRetryError(
+            "retry", set(), set(errors), 1, ["openocd"], "")
+        error.events = [
+            openocd.Event('step', str(i), '') for i in range(finished)]
+        return error
+
+    class FakeTime(object):
+        def __init__(self):
+            self.slept = []
+
+        def sleep(self, seconds):
+            self.slept.append(seconds)
+
+        def time(self):
+            return 0
+
+    def run(results, attempts):
+        """
+        Run the steps with OpenOCD doing the results in turn, returning the
+        steps in each script, the delays and the error (if any).
+        """
+        scripts = []
+
+        def fake_script(board, script, verbose=False, speed=None):
+            scripts.append([c for c in script if c.startswith("step")])
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return []
+
+        fake_time = FakeTime()
+        del done[:]
+        error = None
+        with patched(boards, _openocd_script=fake_script, time=fake_time):
+            try:
+                boards.openocd_run(board, steps, retry=boards.RetryPolicy(
+                    attempts=attempts, backoff=0.5))
+            except boards.OpenOCDRetryError as e:
+                error = e
+        assert not results, results
+        return scripts, fake_time.slept, error
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        retries_path = os.path.join(tmpdir, 'retries.json')
+        speeds_path = os.path.join(tmpdir, 'jtag-speeds.json')
+        cache.save_json(speeds_path, {boards.board_id(board): {'speed': 20}})
+        with patched(boards, _retry_stats_path=lambda: retries_path,
+                     _jtag_speeds_path=lambda: speeds_path,
+                     _dna_path=lambda: os.path.join(tmpdir, 'dna.json')), \
+                patched(lock, lock_path=lambda port: retries_path + '.board'):
+            scripts, slept, error = run([
+                retry_error(0, ["IDCODE"]),
+                retry_error(1, ["DNA"]),
+                [],
+            ], attempts=2)
+            assert error is None, error
+            # Retries start from the step which failed, and a step
+            # finishing means the rest get a fresh set of attempts.
+            assert scripts == [
+                ["step 0", "step 1", "step 2"],
+                ["step 0", "step 1", "step 2"],
+                ["step 1", "step 2"],
+            ], scripts
+            assert done == [0, 1, 2], done
+            assert slept == [0.5, 0.5], slept
+            # Errors at the tuned speed go back to the default speed.
+            assert boards.jtag_speed(board) is None
+            boards._jtag_fallback.discard(boards.board_id(board))
+            assert boards.jtag_speed(board) == 20
+
+            # The delay doubles until the attempts run out.
+            scripts, slept, error = run([
+                retry_error(0, ["DNA"]),
+                retry_error(0, ["DNA"]),
+                retry_error(0, ["DNA"]),
+            ], attempts=3)
+            assert error is not None
+            assert len(scripts) == 3, scripts
+            assert slept == [0.5, 1.0], slept
+            assert done == [], done
+            boards._jtag_fallback.discard(boards.board_id(board))
+
+            assert cache.load_json(retries_path) == {
+                boards.board_id(board): {
+                    'retries': 4,
+                    'failures': 1,
+                    'errors': {'DNA': 4, 'IDCODE': 1},
+                },
+            }, cache.load_json(retries_path)
+
+
+def test_tune_jtag():
+    board = boards.Board(dev=FakeDevice(), type='opsis', state='jtag')
+    speeds = [1000, 2000, 4000, 8000]
+
+    def tune(results):
+        """
+        Tune with OpenOCD giving the (dnas, flash data) results in turn (or
+        raising them), returning the speeds tried.
+        """
+        tried = []
+
+        def fake_script(board, script, verbose=False, speed=None):
+            tried.append(speed)
+            assert script.count(boards.DNA_COMMAND) == boards.JTAG_TUNE_READS
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            dnas, data = result
+            with open(boards._tmp_path(
+                    board, "tune-{}.bin".format(speed)), 'wb') as f:
+                f.write(data)
+            return [openocd.Event('dna', dna, '') for dna in dnas]
+
+        with patched(boards, _openocd_script=fake_script):
+            speed = boards.tune_jtag(board, speeds=speeds)
+        return speed, tried
+
+    good = (['0x0a'] * boards.JTAG_TUNE_READS, b'g' * 100)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with patched(cache, cache_dir=lambda: tmpdir), \
+                patched(lock, lock_path=lambda port: os.path.join(
+                    tmpdir, port + '.lock')):
+            # Stops at the first speed whose flash read differs, and uses
+            # the fastest which worked less the margin.
+            speed, tried = tune([good, good, (good[0], b'x' * 100)])
+            assert tried == [1000, 2000, 4000], tried
+            assert speed == int(2000 * boards.JTAG_SPEED_MARGIN), speed
+            assert boards.jtag_speed(board) == speed
+            assert cache.load_json(boards._jtag_speeds_path()) == {
+                boards.board_id(board): {'speed': speed, 'fastest': 2000},
+            }
+
+            # The DNA reads have to agree with each other.
+            bad_dna = (['0x0a', '0x0b'] + ['0x0a'] * (
+                boards.JTAG_TUNE_READS - 2), good[1])
+            speed, tried = tune([good, bad_dna])
+            assert tried == [1000, 2000], tried
+            assert boards.jtag_speed(board) == int(
+                1000 * boards.JTAG_SPEED_MARGIN)
+
+            # OpenOCD failing stops it too, and every speed can work.
+            error = boards.OpenOCDError("failed", set(), set(), 1, [], "")
+            speed, tried = tune([good, good, good, error])
+            assert tried == speeds, tried
+            assert speed == int(4000 * boards.JTAG_SPEED_MARGIN), speed
+            speed, tried = tune([good] * len(speeds))
+            assert boards.jtag_speed(board) == int(
+                8000 * boards.JTAG_SPEED_MARGIN)
+
+            # Not working at the slowest speed is an error, which leaves the
+            # profile alone.
+            try:
+                tune([error])
+            except AssertionError:
+                pass
+            else:
+                assert False, "tuned a board JTAG doesn't work on"
+            assert boards.jtag_speed(board) == int(
+                8000 * boards.JTAG_SPEED_MARGIN)
+
+
+def test_openocd_output_parser():
+    parser = openocd.OutputParser(lines=3)
+    output = [
+        "Open On-Chip Debugger 0.10.0\n",
+        "Info : clock speed 10000 kHz\n",
+        "DNA = 0101 (0x05)\n",
+        "Info : Found flash device 'micron n25q128' (ID 0x0018ba20)\n",
+        "Info : sector 3 took 120 ms\n",
+        "Warn : something odd\n",
+        "wrote 65536 bytes from file g.bin in 5.1s (12.500 KiB/s)\n",
+    ]
+    events = [parser.feed(line) for line in output]
+    assert [(e.kind, e.value) for e in events if e] == [
+        ('dna', '0x05'),
+        ('flash', 'micron n25q128'),
+        ('progress', '3'),
+        ('warning', 'something odd'),
+        ('speed', '12.500'),
+    ], events
+    assert parser.first('dna') == '0x05'
+    assert not parser.retry
+    assert parser.output() == "".join(output[-3:]), parser.output()
+
+    event = parser.feed("DNA = 0000 (0x18181818)\n")
+    assert event.kind == 'retry', event
+    event = parser.feed("Info : TAP xc6s.tap does not have IDCODE\n")
+    assert event.kind == 'retry', event
+    assert len(parser.retry) == 2, parser.retry
+
+
+def test_flash_changed_runs():
+    size = flash.SECTOR_SIZE
+    old = bytes(range(256)) * (size * 3 // 256)
+    new = bytearray(old)
+    new[size + 10] ^= 0xff
+    new = bytes(new)
+
+    # Chunks are split at sector boundaries, not from the start offset.
+    start = size // 2
+    assert list(flash.chunks(start, size * 2)) == [
+        (start, size // 2), (size, size), (size * 2, size // 2)]
+
+    assert flash.changed_runs(new, 0, old) == [(size, size)]
+    assert flash.changed_runs(new, 0, flash.chunk_hashes(old, 0)) == [
+        (size, size)]
+    assert flash.changed_runs(old, 0, old) == []
+    # Nothing known about the chunks means rewriting all of them.
+    assert flash.changed_runs(new, 0, {}) == [(0, size * 3)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        record = flash.WrittenRecord(
+            "test board", path=os.path.join(tmpdir, 'written.json'))
+        assert record.known(0, len(old)) is None
+        record.record(old, 0)
+        assert record.known(0, len(old)) == flash.chunk_hashes(old, 0)
+        # Writing part of a sector erases the rest of it.
+        record.record(b'x', size * 2 + 1)
+        assert record.known(0, len(old)) is None
+        assert record.known(0, size * 2) is not None
+        record.drop(size + 1, 1)
+        assert record.known(0, size) is not None
+        assert record.known(size, size) is None
+
+
+def test_written_record():
+    size = flash.SECTOR_SIZE
+    old = bytes(range(256)) * (size * 3 // 256)
+    new = bytearray(old)
+    new[size + 10] ^= 0xff
+
+    board = boards.Board(dev=FakeDevice(), type='opsis', state='jtag')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'gateware.bin')
+        with open(filename, 'wb') as f:
+            f.write(new)
+
+        dna_path = os.path.join(tmpdir, 'dna.json')
+        with patched(boards, _dna_path=lambda: dna_path), \
+                patched(lock, lock_path=lambda port: dna_path + '.board'), \
+                patched(cache, cache_dir=lambda: tmpdir):
+            assert boards.written_record(board) is None
+            boards.record_dna(board, [openocd.Event('dna', '0x0a', '')])
+            boards.written_record(board).record(old, 0)
+
+            step = boards._openocd_flash(board, filename, 0, diff='cache')
+            assert step.commands == ["jtagspi_program {} 0x{:x}".format(
+                flash.tmp_path('gateware.bin-{:08x}.bin'.format(size),
+                               board.dev.port), size)], step.commands
+            # Until programming has worked, the sector isn't known.
+            record = boards.written_record(board)
+            assert record.known(0, len(new)) is None
+            assert record.known(0, size) is not None
+            step.done()
+            assert record.known(0, len(new)) == flash.chunk_hashes(new, 0)
+
+            # Another board plugged into the same port doesn't get the
+            # record.
+            class OtherDevice(FakeDevice):
+                path = '/dev/bus/usb/003/050'
+            other = boards.Board(dev=OtherDevice(), type='opsis', state='jtag')
+            assert boards.written_record(other) is None
+            boards.record_dna(other, [openocd.Event('dna', '0x0b', '')])
+            record = boards.written_record(other)
+            assert record.known(0, len(new)) is None
+
+    # Flashing a board whose DNA isn't known runs OpenOCD once, reading the
+    # DNA along with programming.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bios = os.path.join(tmpdir, 'bios.bin')
+        with open(bios, 'wb') as f:
+            f.write(b'b' * 100)
+        location = boards.BOARD_FLASH_MAP['opsis']['bios']
+
+        scripts = []
+
+        def fake_script(board, script, verbose=False, speed=None):
+            scripts.append(script)
+            events = [openocd.Event('dna', '0x0c', '')]
+            if len(scripts) > 1:
+                error = boards.OpenOCDError(
+                    "Fatal error!", set(), set(), 1, ["openocd"], "")
+                error.events = events
+                raise error
+            return events
+
+        dna_path = os.path.join(tmpdir, 'dna.json')
+        with patched(boards, _dna_path=lambda: dna_path,
+                     _openocd_script=fake_script), \
+                patched(lock, lock_path=lambda port: dna_path + '.board'), \
+                patched(cache, cache_dir=lambda: tmpdir):
+            boards.flash_bios(board, bios)
+            assert len(scripts) == 1, scripts
+            assert boards.DNA_COMMAND in scripts[0], scripts[0]
+            record = boards.written_record(board)
+            assert record.known(location, 100) is not None
+
+            # Failing part way through forgets what was erased, even when
+            # the DNA was only read by the run which failed.
+            os.unlink(dna_path)
+            try:
+                boards.flash_bios(board, bios)
+                assert False, "Flashing should fail"
+            except boards.OpenOCDError:
+                pass
+            assert record.known(location, 100) is None
+
+
+def test_flash_first_mismatch():
+    data = bytes(range(256)) * 1000
+    changed = bytearray(data)
+    changed[12345] ^= 1
+    assert flash.first_mismatch(data, data, chunk_size=4096) is None
+    assert flash.first_mismatch(data, changed, chunk_size=4096) == 12345
+    assert flash.first_mismatch(data, data[:-10]) == len(data) - 10
+
+    assert boards.flash_region('opsis', 'bios') == (0x200000, 0x8000)
+    assert boards.flash_region('opsis', 'firmware') == (
+        0x208000, 0x1000000 - 0x208000)
+    assert boards.flash_region('mimasv2', 'all') == (0, 0x200000)
+
+
+def test_flash_image():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        a = os.path.join(tmpdir, 'a.bin')
+        b = os.path.join(tmpdir, 'b.bin')
+        with open(a, 'wb') as f:
+            f.write(b'a' * 10)
+        with open(b, 'wb') as f:
+            f.write(b'b' * 5)
+
+        image = flash.FlashImage([(0x20, b), (0x10, a)])
+        assert (image.start, len(image)) == (0x10, 0x15), image
+        assert max(len(c) for c in image.chunks(chunk_size=4)) == 4
+        out = image.write(os.path.join(tmpdir, 'image.bin'))
+        with open(out, 'rb') as f:
+            assert f.read() == b'a' * 10 + b'\xff' * 6 + b'b' * 5
+
+        image = flash.FlashImage([(0x10, a)], start=0)
+        assert b"".join(image.chunks()) == b'\xff' * 0x10 + b'a' * 10
+
+        try:
+            flash.FlashImage([(0x0, a), (0x8, b)])
+            assert False, "Overlapping parts should fail"
+        except ValueError:
+            pass
+
+    # Boards being worked on at the same time don't share files.
+    assert flash.tmp_path('image.bin', '1-1') != flash.tmp_path(
+        'image.bin', '1-2')
+
+
+def test_compose_image():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gateware = os.path.join(tmpdir, 'gateware.bin')
+        with open(gateware, 'wb') as f:
+            f.write(files.XilinxBinFile.HEADER + b'g' * 100)
+        bios = os.path.join(tmpdir, 'bios.bin')
+        with open(bios, 'wb') as f:
+            f.write(b'b' * 100)
+
+        image = boards.compose_image('opsis', bios=bios, clear_firmware=True)
+        assert image.start == boards.BOARD_FLASH_MAP['opsis']['bios'], image
+        image = boards.compose_image('opsis', gateware=gateware, bios=bios)
+        assert image.start == 0, image
+
+        # Padding between the parts would erase the bios.
+        for start in (None, 0):
+            try:
+                boards.compose_image(
+                    'opsis', gateware=gateware, clear_firmware=True,
+                    start=start)
+                assert False, "Gap between the parts should fail"
+            except AssertionError as e:
+                assert 'bios region' in str(e), e
+        # As would padding before them from the start of the flash.
+        try:
+            boards.compose_image('opsis', bios=bios, start=0)
+            assert False, "Gap before the parts should fail"
+        except AssertionError as e:
+            assert 'gateware region' in str(e), e
+
+
+def write_fbi_file(filename, data):
+    """Write data as a FlashBootImage (.fbi) to filename."""
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('>II', len(data), binascii.crc32(data)) + data)
+
+
+def test_flash_shared_sector():
+    board = boards.Board(dev=FakeDevice(), type='opsis', state='jtag')
+    bios_start = boards.BOARD_FLASH_MAP['opsis']['bios']
+    assert boards.regions_share_sectors('opsis', ['bios', 'firmware'])
+    assert not boards.regions_share_sectors('opsis', ['gateware', 'firmware'])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        old_bios = os.path.join(tmpdir, 'old-bios.bin')
+        bios = os.path.join(tmpdir, 'bios.bin')
+        firmware = os.path.join(tmpdir, 'firmware.fbi')
+        with open(old_bios, 'wb') as f:
+            f.write(b'a' * 100)
+        with open(bios, 'wb') as f:
+            f.write(b'b' * 100)
+        write_fbi_file(firmware, b'f' * 0x9000)
+
+        dna_path = os.path.join(tmpdir, 'dna.json')
+        with patched(boards, _dna_path=lambda: dna_path), \
+                patched(cache, cache_dir=lambda: tmpdir):
+            boards.record_dna(board, [openocd.Event('dna', '0x0a', '')])
+            # What was flashed last time.
+            image = boards.compose_image('opsis', bios=old_bios,
+                                         firmware=firmware)
+            boards.written_record(board).record(
+                flash.read_mapped(image.write(
+                    os.path.join(tmpdir, 'old.bin'))), image.start)
+
+            # Only the bios changed, but programming it erases the start of
+            # the firmware so that has to be written again too.
+            parser = cli.args_parser('opsis', 'mode-switch')
+            args = parser.parse_args([
+                '--flash-softcpu-bios', bios,
+                '--flash-softcpu-firmware', firmware,
+                '--diff-flash', 'cache', '--no-verify'])
+            steps = cli.jtag_steps(args, board)
+            commands = [c for s in steps for c in s.commands]
+            assert len(commands) == 1, commands
+            _, path, offset = commands[0].split()
+            assert int(offset, 16) == bios_start, commands
+            with open(path, 'rb') as f:
+                data = f.read()
+            assert len(data) == flash.SECTOR_SIZE, len(data)
+            assert data[:100] == b'b' * 100
+            assert data[0x8000:0x8008] == struct.pack(
+                '>II', 0x9000, binascii.crc32(b'f' * 0x9000))
+
+
+def test_snapshot_store():
+    size = flash.SECTOR_SIZE
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = snapshot.SnapshotStore(os.path.join(tmpdir, 'store'))
+        gateware = os.path.join(tmpdir, 'gateware.bin')
+        bios = os.path.join(tmpdir, 'bios.bin')
+        with open(gateware, 'wb') as f:
+            f.write(b'\xff' * size * 2)
+        with open(bios, 'wb') as f:
+            f.write(b'b' * 100)
+
+        path = store.add('board', 'opsis', [
+            ('gateware', 0, gateware), ('bios', size * 2, bios)])
+        assert store.find('board') == path
+        assert store.find('board', os.path.basename(path)) == path
+
+        # The two identical empty sectors are only stored once.
+        chunks = []
+        for _, _, names in os.walk(os.path.join(tmpdir, 'store', 'chunks')):
+            chunks += names
+        assert len(chunks) == 2, chunks
+
+        regions = store.load(path)['regions']
+        out = store.write_region(regions[1], os.path.join(tmpdir, 'out.bin'))
+        with open(out, 'rb') as f:
+            assert f.read() == b'b' * 100
+
+
+def test_snapshot_restore():
+    board = boards.Board(dev=FakeDevice(), type='opsis', state='jtag')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = snapshot.SnapshotStore(os.path.join(tmpdir, 'store'))
+        dna_path = os.path.join(tmpdir, 'dna.json')
+        with patched(boards, _dna_path=lambda: dna_path), \
+                patched(cache, cache_dir=lambda: tmpdir):
+            step = boards.snapshot_step(board, store=store)
+            for name in boards.BOARD_FLASH_MAP['opsis']:
+                _, length = boards.flash_region('opsis', name)
+                filename = boards._tmp_path(
+                    board, "snapshot-{}.bin".format(name))
+                with open(filename, 'wb') as f:
+                    f.truncate(length)
+            boards.record_dna(board, [openocd.Event('dna', '0x0a', '')])
+            step.done()
+            assert store.manifests(boards.dna_key(board))
+
+            # The snapshot is put back as one image, and nothing has
+            # changed since it was taken.
+            steps = boards.restore_steps(board, store=store)
+            assert len(steps) == 1, steps
+            assert steps[0].commands == [], steps[0].commands
+
+            # Another board in the same port has no snapshots.
+            boards.record_dna(board, [openocd.Event('dna', '0x0b', '')])
+            try:
+                boards.restore_steps(board, store=store)
+            except AssertionError as e:
+                assert "No snapshots" in str(e), e
+            else:
+                assert False, "restored another board's snapshot"
+
+
+def test_updating_json():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'counts.json')
+
+        def count():
+            for _ in range(20):
+                with cache.updating_json(path, {}) as counts:
+                    counts['n'] = counts.get('n', 0) + 1
+
+        # No update is lost, however the processes (here threads, each with
+        # their own lock file) interleave.
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert cache.load_json(path) == {'n': 80}, cache.load_json(path)
+
+        # Nothing is saved when the update fails.
+        try:
+            with cache.updating_json(path, {}) as counts:
+                counts['n'] = 0
+                raise ValueError()
+        except ValueError:
+            pass
+        assert cache.load_json(path) == {'n': 80}
+
+
+class FakeDevice(object):
+    """USB device of an Opsis in jtag mode, which isn't plugged in."""
+    serialno = 'hw_opsis'
+    port = '3-1.4'
+    path = '/dev/bus/usb/003/042'
+
+    def inuse(self):
+        return False
+
+
+def test_fx2_load_skipped():
+    class FX2Device(FakeDevice):
+        vid, pid, did = 0x2a19, 0x5442, '0001'
+
+        def __init__(self, path):
+            self.path = path
+
+    devices = []
+
+    class FakeRegistry(object):
+        """The board re-enumerates at a new path every time."""
+
+        def __init__(self, **kwargs):
+            self.devices = {}
+            self.boards = {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def wait_for(self, predicate, timeout=None):
+            dev = FX2Device('/dev/bus/usb/003/{:03d}'.format(
+                43 + len(devices)))
+            devices.append(dev)
+            self.devices[dev.port] = dev
+            return predicate(self)
+
+    loaded = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        firmware = os.path.join(tmpdir, 'firmware.ihex')
+        other = os.path.join(tmpdir, 'other.ihex')
+        for filename in (firmware, other):
+            with open(filename, 'w') as f:
+                f.write(filename)
+
+        with patched(cache, cache_dir=lambda: tmpdir,
+                     runtime_dir=lambda: tmpdir), \
+                patched(lock, lock_path=lambda port: os.path.join(
+                    tmpdir, port + '.lock')), \
+                patched(hotplug, HotplugRegistry=FakeRegistry), \
+                patched(boards, _load_fx2_file=lambda board, filepath, **kw:
+                        loaded.append((board.dev.path, filepath))):
+            board = boards.Board(
+                dev=FX2Device('/dev/bus/usb/003/042'), type='opsis',
+                state='operational')
+            board = boards.load_fx2(board, filename=firmware)
+            assert board.dev is devices[-1], board.dev
+            assert len(loaded) == 1, loaded
+
+            # Already running, so not loaded again.
+            assert boards.load_fx2(board, filename=firmware) is board
+            assert len(loaded) == 1, loaded
+
+            # Unless forced, or asked for different firmware.
+            board = boards.load_fx2(board, filename=firmware, force=True)
+            assert len(loaded) == 2, loaded
+            board = boards.load_fx2(board, filename=other)
+            assert loaded[-1] == (devices[-2].path, other), loaded
+
+            # Or the board re-enumerated since (say it was reset).
+            board = boards.Board(
+                dev=FX2Device('/dev/bus/usb/003/099'), type='opsis',
+                state='operational')
+            boards.load_fx2(board, filename=other)
+            assert loaded[-1] == ('/dev/bus/usb/003/099', other), loaded
+            assert len(loaded) == 4, loaded
+
+
+def test_dna_cache():
+    board = boards.Board(dev=FakeDevice(), type='opsis', state='jtag')
+
+    dna_path = boards._dna_path
+    with tempfile.TemporaryDirectory() as tmpdir:
+        boards._dna_path = lambda: os.path.join(tmpdir, 'dna.json')
+        try:
+            steps = [boards.Step(["init", boards.DNA_COMMAND], ["reset"])]
+            assert boards.cached_dna(board) is None
+            assert boards._skip_known_dna(board, steps) == steps
+
+            parser = openocd.OutputParser()
+            parser.feed("DNA = 1010 (0x0a)\n")
+            assert boards.record_dna(board, parser.events) == '0x0a'
+            assert boards.cached_dna(board) == '0x0a'
+            assert boards.cached_dna(board, max_age=-1) is None
+            assert boards._skip_known_dna(board, steps) == [
+                boards.Step(["init"], ["reset"])]
+
+            # The same board after load_fx2() changed its firmware.
+            class SerialDevice(FakeDevice):
+                serialno = '0123456789'
+                path = '/dev/bus/usb/003/043'
+            serial = boards.Board(
+                dev=SerialDevice(), type='opsis', state='serial')
+            assert boards.cached_dna(serial) is None
+            boards._follow_dna(board.dev, serial.dev)
+            assert boards.cached_dna(serial) == '0x0a'
+            # Anything else turning up at the port isn't the same board.
+            assert boards.cached_dna(board) is None
+            boards._follow_dna(board.dev, serial.dev)
+            assert boards.cached_dna(serial) == '0x0a'
+        finally:
+            boards._dna_path = dna_path
+
+
+def test_boards_cache():
+    snapshot = sysfs.SysfsSnapshot.take()
+    names = sorted(snapshot.devices)[:1]
+    subset = snapshot.subset(names)
+    assert sorted(subset.devices) == names, subset.devices
+    loaded = sysfs.SysfsSnapshot.from_json(subset.to_json())
+    assert loaded[1:] == subset[1:], (loaded, subset)
+
+    cache_path = boards._boards_cache_path
+    with tempfile.TemporaryDirectory() as tmpdir:
+        boards._boards_cache_path = lambda: os.path.join(tmpdir, 'boards.json')
+        try:
+            found = boards.find_boards()
+            assert boards.find_boards(cached=True) == found
+            assert os.path.exists(boards._boards_cache_path())
+            # The second time round comes from the cache.
+            assert boards.find_boards(cached=True) == found
+            boards.invalidate_boards()
+            assert not os.path.exists(boards._boards_cache_path())
+        finally:
+            boards._boards_cache_path = cache_path
+
+
+def test_find_boards_selectors():
+    found = boards.find_boards()
+
+    # Selectors only look at the devices they could match.
+    for board in found:
+        assert boards.find_boards(types=[board.type], ports=[
+            board.dev.port])[0].dev == board.dev
+    others = [b for b in found if b.type != 'opsis']
+    assert boards.find_boards(types=['atlys']) == others, others
+
+
+# Seconds importing the command line tool may take, it is run from
+# monitoring scripts many times a day.
+IMPORT_TIME_BUDGET = 0.5
+
+
+def test_import_time():
+    # Importing must not start any processes (like git or unbind-helper).
+    code = "\n".join([
+        "import subprocess, time",
+        "def fail(self, *args, **kw):",
+        "    raise AssertionError('Started %r while importing' % (args,))",
+        "subprocess.Popen.__init__ = fail",
+        "start = time.time()",
+        "import hdmi2usb.modeswitch.cli",
+        "print(time.time() - start)",
+    ])
+    times = []
+    for i in range(3):
+        output = subprocess.check_output([sys.executable, '-c', code])
+        times.append(float(output))
+    assert min(times) < IMPORT_TIME_BUDGET, (
+        "Import took {:.3f}s, budget is {}s".format(
+            min(times), IMPORT_TIME_BUDGET))
+
+
+def test_board_output():
+    out = io.StringIO()
+    stream = cli.BoardOutput(out)
+
+    def board(name):
+        stream.set_board(name)
+        stream.write("one\ntw")
+        stream.write("o\n")
+        stream.write("three")
+        stream.flush()
+
+    threads = [threading.Thread(target=board, args=(n,)) for n in "ab"]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stream.write("main\n")
+
+    lines = out.getvalue().splitlines()
+    for name in "ab":
+        assert [line for line in lines if line.startswith("[%s]" % name)] == [
+            "[%s] one" % name, "[%s] two" % name, "[%s] three" % name], lines
+    assert lines[-1] == "main", lines
+
+
+def test_check_args():
+    parser = cli.args_parser('opsis', 'mode-switch')
+
+    def check(argv):
+        args = parser.parse_args(argv)
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                cli.check_args(parser, args)
+        except SystemExit:
+            return False
+        return True
+
+    assert check(['--mode', 'jtag', '--flash-gateware', 'g.bin'])
+    assert check(['--mode', 'serial', '--load-fx2-firmware', 'f.ihx'])
+    # FX2 operations would silently stop the JTAG ones from running.
+    assert not check(['--load-fx2-firmware', 'f.ihx', '--flash-gateware',
+                      'g.bin'])
+    assert not check(['--flash-fx2-eeprom', 'f.dfu', '--tune-jtag'])
+    assert not check(['--flash-fx2-eeprom', 'f.dfu', '--load-fx2-firmware',
+                      'f.ihx'])
+
+    # Each board needs its own file to read the flash into.
+    assert not check(['--all', '--read-flash', 'all', '-o', 'flash.bin'])
+    assert check(['--all', '--read-flash', 'all', '-o', 'flash-{port}.bin'])
+    args = parser.parse_args(['-o', 'flash-{port}.bin'])
+    board = boards.Board(dev=FakeDevice(), type='opsis', state='jtag')
+    assert cli.output_path(args, board) == 'flash-3-1.4.bin'
+
+
+def test_board_lock():
+    lock_path = lock.lock_path
+    with tempfile.TemporaryDirectory() as tmpdir:
+        lock.lock_path = lambda port: os.path.join(tmpdir, port + '.lock')
+        try:
+            path = lock.lock_path('1-2')
+            with lock.BoardLock('1-2'):
+                # Reentrant in the same thread.
+                with lock.BoardLock('1-2', timeout=0):
+                    pass
+
+                # Another process (open file) can't lock it.
+                with open(path, 'r') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                        assert False, "Lock should be held"
+                    except BlockingIOError:
+                        pass
+
+            with open(path, 'r') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                # Shared locks can be held together.
+                with lock.BoardLock('1-2', shared=True, timeout=0) as held:
+                    assert not held.waited
+                try:
+                    with lock.BoardLock('1-2', timeout=0.2):
+                        assert False, "Lock should time out"
+                except lock.LockTimeout:
+                    pass
+        finally:
+            lock.lock_path = lock_path
+
+
+def test_board_pipeline_waits():
+    board = boards.Board(dev=FakeDevice(), type='opsis', state='serial')
+    switched = boards.Board(dev=FakeDevice(), type='opsis', state='jtag')
+    found = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with patched(lock, lock_path=lambda port: os.path.join(
+                tmpdir, port + '.lock')), \
+                patched(boards, find_boards=lambda **kw: [switched]), \
+                patched(cli, _board_pipeline=lambda a, m, b: found.append(b)):
+            # Another process switches the board's mode while we wait.
+            f = open(lock.lock_path(board.dev.port), 'w')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            timer = threading.Timer(0.2, f.close)
+            timer.start()
+            args = cli.args_parser('opsis', 'mode-switch').parse_args([])
+            cli.board_pipeline(args, 'mode-switch', board)
+            timer.join()
+            assert found == [switched], found
+
+
+def test_lock_dir():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        lock_dir = os.path.join(tmpdir, 'hdmi2usb')
+        umask = os.umask(0o077)
+        try:
+            with patched(lock, LOCK_DIR=lock_dir):
+                path = lock.lock_path('1-2')
+                with lock.BoardLock('1-2'):
+                    pass
+                # Other users can use the locks whatever the umask.
+                assert os.stat(lock_dir).st_mode & 0o7777 == 0o1777
+                assert os.stat(path).st_mode & 0o777 == 0o666
+
+                with patched(lock, LOCK_DIR=os.path.join(tmpdir, 'a', 'b')):
+                    try:
+                        lock.lock_path('1-2')
+                        assert False, "Missing /run/lock should fail"
+                    except lock.LockDirError:
+                        pass
+        finally:
+            os.umask(umask)
+
+
 test_libusb_and_lsusb_equal()
+test_sysfs_and_lsusb_equal()
+test_hotplug_registry_events()
+test_hotplug_registry_ports()
+test_fx2_load_ram()
+test_dfu_download()
+test_planner_avoids_flaky_transitions()
+test_openocd_session()
+test_openocd_merge_steps()
+test_openocd_retry()
+test_tune_jtag()
+test_openocd_output_parser()
+test_flash_changed_runs()
+test_written_record()
+test_flash_first_mismatch()
+test_flash_image()
+test_compose_image()
+test_flash_shared_sector()
+test_snapshot_store()
+test_snapshot_restore()
+test_updating_json()
+test_fx2_load_skipped()
+test_dna_cache()
+test_boards_cache()
+test_find_boards_selectors()
+test_import_time()
+test_board_output()
+test_check_args()
+test_board_lock()
+test_board_pipeline_waits()
+test_lock_dir()
@@ -1,7 +1,5 @@
 #!/bin/bash
 set -e
-hdmi2usb-mode-switch --mode=serial -v
-hdmi2usb-mode-switch --mode=jtag -v
-hdmi2usb-mode-switch --mode=serial -v
-hdmi2usb-mode-switch --mode=jtag -v
+# The mode switch goes via serial mode where going straight to jtag is known to
+# be unreliable, see FLAKY_TRANSITIONS in hdmi2usb/modeswitch/planner.py.
 hdmi2usb-mode-switch --flash-gateware=$1 --verbose